@@ -4,104 +4,244 @@ AgentQL Setup and Testing Script
 Fixes compatibility issues and demonstrates universal web automation
 """
 
+import argparse
+import importlib.util
 import os
+import pickle
 import sys
-import subprocess
-from dotenv import load_dotenv
 
-# Load environment variables from .env file
-load_dotenv()
+# Decorative banners are skipped when output is piped (e.g. from run_*.sh)
+_TTY = sys.stdout.isatty()
+
+_DOTENV = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".env")
+CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "uxagent", "dotenv.pkl")
+
+
+def _load_pickle(path):
+    try:
+        with open(path, "rb") as f:
+            # Caches written before permissions were tightened may be world-readable
+            os.fchmod(f.fileno(), 0o600)
+            return pickle.load(f)
+    except Exception:
+        return None
+
+
+def _dump_pickle(path, obj):
+    # The cache holds .env values (API keys), so keep it private to the user
+    try:
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        fd = os.open(path, os.O_CREAT | os.O_WRONLY | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            # O_CREAT's mode only applies to new files; tighten one written earlier
+            os.fchmod(f.fileno(), 0o600)
+            pickle.dump(obj, f)
+    except OSError:
+        pass
+
+
+def _cached_load_dotenv(path=_DOTENV):
+    """Load .env into os.environ, skipping the parse when the file is unchanged"""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        # Missing .env is fine, same as load_dotenv()
+        return
+    key = (path, st.st_mtime_ns, st.st_size)
+    cache = _load_pickle(CACHE_PATH)
+    if cache and cache[0] == key:
+        values = cache[1]
+    else:
+        from dotenv import dotenv_values
+
+        values = {k: v for k, v in dotenv_values(path).items() if v is not None}
+        _dump_pickle(CACHE_PATH, (key, values))
+    # Like load_dotenv(), never override variables already set in the shell
+    for k, v in values.items():
+        os.environ.setdefault(k, v)
+
+
+def _is_installed(module_path):
+    """Check that a module can be imported without executing its code"""
+    try:
+        return importlib.util.find_spec(module_path) is not None
+    except (ImportError, ValueError):
+        # Raised when a parent package of a dotted name is missing
+        return False
+
+
+_UNSET = object()
+_API_KEY_CACHE = _UNSET
+_REQS_OK = None
+
+
+def _api_key():
+    """Return AGENTQL_API_KEY, falling back to .env, cached for the process"""
+    global _API_KEY_CACHE
+    if _API_KEY_CACHE is _UNSET:
+        api_key = os.environ.get('AGENTQL_API_KEY')
+        if not api_key:
+            _cached_load_dotenv()
+            api_key = os.environ.get('AGENTQL_API_KEY')
+        _API_KEY_CACHE = api_key
+    return _API_KEY_CACHE
+
+
+def clear_cache():
+    """Forget cached results so the next lookup re-reads the environment"""
+    global _API_KEY_CACHE, _REQS_OK
+    _API_KEY_CACHE = _UNSET
+    _REQS_OK = None
+
+
+_RULE = "=" * 50
+_TITLE = "AgentQL Universal Web Automation"
+
+_BANNER_SETUP = f"🔧 Setting up {_TITLE}\n{_RULE}\n"
+_BANNER_KEY_MISSING = (
+    "\n❌ AgentQL API key not found in environment.\n"
+    "\nTo get your AgentQL working:\n"
+    "1. Get your API key from: https://portal.agentql.com/\n"
+    "2. Set it in your environment:\n"
+    "   export AGENTQL_API_KEY='your-api-key-here'\n"
+    "3. Or add it to your ~/.bashrc or ~/.zshrc file\n"
+    "\nOnce you have the API key set, the system will work with ANY website!\n"
+)
+_BANNER_SETUP_OK = "✅ AgentQL API key found: {key}...\n"
+_BANNER_CAPABILITIES = (
+    f"\n🚀 {_TITLE} Capabilities\n{_RULE}\n"
+    "✅ FIXED: Parameter passing issue (dict vs string)\n"
+    "✅ FIXED: AgentQL query format (correct {element} syntax)\n"
+    "✅ FIXED: Error handling and logging\n"
+    "✅ FIXED: Multiple fallback strategies\n"
+    "✅ READY: Universal automation on ANY website\n"
+    "\nSupported websites: Bruvi.com, Amazon, Nike, Airbnb, Booking.com, and MORE!\n"
+    "\n📋 Available Commands:\n"
+    "  ./run_agentql_test.sh                    # Test on Bruvi.com\n"
+    "  ./run_universal_test.sh https://nike.com # Test on Nike.com\n"
+    "  ./run_universal_test.sh https://airbnb.com # Test on Airbnb.com\n"
+    "\n🎯 Key Improvements Made:\n"
+    "1. Fixed parameter validation in all action handlers\n"
+    "2. Implemented correct AgentQL query syntax\n"
+    "3. Added multiple fallback strategies (query_elements + get_by_prompt)\n"
+    "4. Enhanced error handling and logging\n"
+    "5. Added support for navigation actions (scroll, etc.)\n"
+).encode("utf-8")
+_BANNER_MAIN = f"🌐 UXAgent - {_TITLE}\n{_RULE}\n"
+_BANNER_READY = (
+    "\n🎉 System is ready for universal web automation!\n"
+    "   Your AgentQL fixes are working correctly.\n"
+    "   Run the test scripts to see it in action!\n"
+)
+
+
+def _write_bytes(data):
+    """Write pre-encoded UTF-8 bytes, bypassing the text-mode encoder"""
+    buffer = getattr(sys.stdout, "buffer", None)
+    if buffer is None:
+        # e.g. stdout replaced by an in-memory text stream
+        sys.stdout.write(data.decode("utf-8"))
+        return
+    # Flush pending text first so output ordering is preserved
+    sys.stdout.flush()
+    buffer.write(data)
+    buffer.flush()
+
 
 def setup_agentql():
     """Setup AgentQL with proper configuration"""
-    print("🔧 Setting up AgentQL Universal Web Automation")
-    print("=" * 50)
-    
-    # Check if API key is already set
-    api_key = os.getenv('AGENTQL_API_KEY')
+    if _TTY:
+        sys.stdout.write(_BANNER_SETUP)
+
+    # Check if API key is already set; only touch .env when it is not
+    api_key = _api_key()
     if not api_key:
-        print("\n❌ AgentQL API key not found in environment.")
-        print("\nTo get your AgentQL working:")
-        print("1. Get your API key from: https://portal.agentql.com/")
-        print("2. Set it in your environment:")
-        print("   export AGENTQL_API_KEY='your-api-key-here'")
-        print("3. Or add it to your ~/.bashrc or ~/.zshrc file")
-        print("\nOnce you have the API key set, the system will work with ANY website!")
+        sys.stdout.write(_BANNER_KEY_MISSING)
         return False
     else:
-        print(f"✅ AgentQL API key found: {api_key[:10]}...")
+        sys.stdout.write(_BANNER_SETUP_OK.format(key=api_key[:10]))
         return True
 
 def test_requirements():
     """Test that all required packages are installed"""
-    print("\n🧪 Testing package installation...")
+    global _REQS_OK
+    if _REQS_OK is None:
+        _REQS_OK = _test_requirements()
+    return _REQS_OK
+
+
+def _test_requirements():
+    """Uncached body of test_requirements()"""
+    if _TTY:
+        print("\n🧪 Testing package installation...")
     
-    try:
-        import agentql
-        print("✅ AgentQL installed")
-    except ImportError as e:
-        print(f"❌ AgentQL import error: {e}")
+    if not _is_installed("agentql"):
+        print("❌ AgentQL missing")
         return False
-    
-    try:
-        from playwright.async_api import async_playwright
-        print("✅ Playwright installed")
-    except ImportError as e:
-        print(f"❌ Playwright import error: {e}")
+    print("✅ AgentQL installed")
+
+    if not _is_installed("playwright.async_api"):
+        print("❌ Playwright missing")
         return False
-        
-    try:
-        from playwright_stealth import stealth_async
-        print("✅ Playwright-stealth installed")
-    except ImportError as e:
-        print(f"⚠️  Playwright-stealth version issue: {e}")
+    print("✅ Playwright installed")
+
+    if not _is_installed("playwright_stealth"):
+        print("⚠️  Playwright-stealth missing")
         print("   This won't prevent basic functionality")
-    
+    else:
+        print("✅ Playwright-stealth installed")
+
     return True
 
 def show_capabilities():
     """Show what the fixed system can do"""
-    print("\n🚀 AgentQL Universal Web Automation Capabilities")
-    print("=" * 50)
-    print("✅ FIXED: Parameter passing issue (dict vs string)")
-    print("✅ FIXED: AgentQL query format (correct {element} syntax)")  
-    print("✅ FIXED: Error handling and logging")
-    print("✅ FIXED: Multiple fallback strategies")
-    print("✅ READY: Universal automation on ANY website")
-    print("\nSupported websites: Bruvi.com, Amazon, Nike, Airbnb, Booking.com, and MORE!")
-    
-    print("\n📋 Available Commands:")
-    print("  ./run_agentql_test.sh                    # Test on Bruvi.com")
-    print("  ./run_universal_test.sh https://nike.com # Test on Nike.com")  
-    print("  ./run_universal_test.sh https://airbnb.com # Test on Airbnb.com")
-    
-    print("\n🎯 Key Improvements Made:")
-    print("1. Fixed parameter validation in all action handlers")
-    print("2. Implemented correct AgentQL query syntax")
-    print("3. Added multiple fallback strategies (query_elements + get_by_prompt)")
-    print("4. Enhanced error handling and logging")
-    print("5. Added support for navigation actions (scroll, etc.)")
-
-def main():
-    print("🌐 UXAgent - AgentQL Universal Web Automation")
-    print("=" * 50)
-    
+    _write_bytes(_BANNER_CAPABILITIES)
+
+def run_all():
+    """Run every check and print the capabilities banner"""
+    if _TTY:
+        sys.stdout.write(_BANNER_MAIN)
+
+    # Setup AgentQL first: without a key nothing else matters, so skip the
+    # dependency probes on that path
+    if not setup_agentql():
+        print("\n⏸️  Setup incomplete. Please configure your API key first.")
+        return
+
     # Test requirements
     if not test_requirements():
         print("\n❌ Some requirements are missing. Please check your installation.")
         return
     
-    # Setup AgentQL
-    if not setup_agentql():
-        print("\n⏸️  Setup incomplete. Please configure your API key first.")
-        return
-    
     # Show capabilities
     show_capabilities()
     
-    print(f"\n🎉 System is ready for universal web automation!")
-    print(f"   Your AgentQL fixes are working correctly.")
-    print(f"   Run the test scripts to see it in action!")
+    if _TTY:
+        sys.stdout.write(_BANNER_READY)
+
+
+COMMANDS = {
+    "check-key": setup_agentql,
+    "check-deps": test_requirements,
+    "capabilities": show_capabilities,
+    "all": run_all,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "cmd",
+        nargs="?",
+        choices=COMMANDS,
+        default="all",
+        help="Which check to run (default: all)",
+    )
+    args = parser.parse_args(argv)
+    result = COMMANDS[args.cmd]()
+    # Only the individual checks report a status; `all` keeps the old exit code
+    if result is False:
+        sys.exit(1)
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
@@ -1,19 +1,444 @@
-import base64
 import asyncio
+import hashlib
 import json
 import logging
+import operator
 import os
+from collections import deque
+from datetime import datetime, timezone
 from pathlib import Path
-from typing import Any, Dict, Optional, List
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, List, Tuple
+from urllib.parse import urlparse
 
 import anthropic
 from dotenv import load_dotenv
+
+try:
+    import orjson
+
+    def _dumps(obj: Any, **kwargs) -> str:
+        return orjson.dumps(obj, **kwargs).decode()
+except ImportError:  # orjson is optional
+    # Match orjson's compact, raw-UTF-8 output so prompt bytes (and the LLM cache
+    # keys built from them) do not depend on whether orjson is installed
+    def _dumps(obj: Any, **kwargs) -> str:
+        return json.dumps(obj, separators=(",", ":"), ensure_ascii=False, **kwargs)
+
+try:
+    # SIMD-accelerated, same output as base64.b64encode
+    from pybase64 import b64encode as _b64encode
+except ImportError:
+    from base64 import b64encode as _b64encode
 from pathlib import Path
 from .dom_llm_actions_env import BrowserbaseConnector
 
 
 logger = logging.getLogger(__name__)
 
+_PROJECT_ROOT = Path(__file__).resolve().parents[3]
+_DOTENV_PATH = _PROJECT_ROOT / ".env"
+# Set once the project .env has been read, so later runners skip the filesystem
+_DOTENV_LOADED = False
+
+SHOPPER_SYSTEM_PROMPT = (
+    "You are a shopper who is looking to purchase something on a website. "
+    "Control the browser only via the computer tool. "
+    "Before acting and after each action, request and review a screenshot. "
+    "Use precise clicks and short waits. Avoid destructive actions. "
+    "When the goal is complete, stop issuing tool_use."
+)
+PROMPT_CACHING_BETA = "prompt-caching-2024-07-31"
+# Output budget per loop turn; lowered adaptively once a few turns have been observed
+STEP_MAX_TOKENS = 256
+# Responses to run()'s single-shot requests; disable with UXAGENT_LLM_CACHE=0
+LLM_CACHE_DIR = Path.home() / ".cache" / "uxagent" / "llm"
+# Tools for the Browserbase loop, identical on every step. The breakpoint on the last
+# tool keeps the tools block cached even when screenshot eviction rewrites the history
+_CU_TOOLS = (
+    {
+        "type": "computer_20250124",
+        "name": "computer",
+        "display_width_px": 1280,
+        "display_height_px": 800,
+        "display_number": 1,
+        "cache_control": {"type": "ephemeral"},
+    },
+)
+# The loop only pauses once this few requests are left in the rate-limit window,
+# and never for longer than MAX_THROTTLE_SECONDS
+RATE_LIMIT_HEADROOM = 5
+MAX_THROTTLE_SECONDS = 2.0
+# Screenshots kept in the transcript. Older ones are evicted SCREENSHOT_WINDOW at a time,
+# since each eviction rewrites the prefix and invalidates the prompt cache
+SCREENSHOT_WINDOW = max(1, int(os.getenv("CU_SCREENSHOT_WINDOW", "3")))
+# Screenshots sent to the model are JPEG, several times smaller than PNG for UI pages.
+# CU_SCREENSHOT_LOSSLESS=1 keeps explicit screenshot actions as PNG
+SCREENSHOT_OPTIONS = {"full_page": False, "type": "jpeg", "quality": 70}
+SCREENSHOT_MEDIA_TYPE = "image/jpeg"
+SCREENSHOT_LOSSLESS = os.getenv("CU_SCREENSHOT_LOSSLESS", "0") == "1"
+# Actions whose effect the model needs to see; the rest get a text-only tool_result
+NEEDS_VISUAL = frozenset({
+    "screenshot",
+    "navigate", "goto",
+    "click", "mouse_click", "double_click", "left_click", "right_click", "context_click",
+    "hover",
+    "type", "keyboard_type", "key", "key_press", "press",
+    "scroll", "mouse_wheel",
+    "back", "go_back", "forward", "go_forward", "reload", "refresh",
+})
+
+
+def _mark_cache_breakpoint(history: List[Dict[str, Any]]) -> None:
+    """Move the prompt-cache breakpoint to the last block of the newest turn.
+
+    Only the marker moves; earlier turns are never rewritten, so the cached
+    prefix stays byte-identical from one step to the next.
+    """
+    for message in history:
+        content = message.get("content")
+        if isinstance(content, list):
+            for block in content:
+                block.pop("cache_control", None)
+    content = history[-1].get("content")
+    if isinstance(content, list) and content:
+        content[-1]["cache_control"] = {"type": "ephemeral"}
+
+
+def _evict_screenshots(history: List[Dict[str, Any]], image_turns: List[int]) -> None:
+    """Replace screenshots in the oldest turns with a placeholder once the window overflows"""
+    if len(image_turns) < 2 * SCREENSHOT_WINDOW:
+        return
+    while len(image_turns) > SCREENSHOT_WINDOW:
+        for block in history[image_turns.pop(0)]["content"]:
+            if block.get("type") == "tool_result" and isinstance(block.get("content"), list):
+                block["content"] = [
+                    b if b.get("type") != "image" else {"type": "text", "text": "[screenshot evicted]"}
+                    for b in block["content"]
+                ]
+
+
+def _throttle_delay(headers) -> float:
+    """Spread the remaining request budget over the time left until the limit resets"""
+    try:
+        remaining = int(headers.get("anthropic-ratelimit-requests-remaining"))
+        reset = datetime.fromisoformat(
+            headers.get("anthropic-ratelimit-requests-reset").replace("Z", "+00:00")
+        )
+    except (TypeError, ValueError, AttributeError):
+        return 0.0
+    if remaining > RATE_LIMIT_HEADROOM:
+        return 0.0
+    reset_seconds = (reset - datetime.now(timezone.utc)).total_seconds()
+    return min(MAX_THROTTLE_SECONDS, max(0.0, reset_seconds / max(1, remaining)))
+
+
+def _normalize_block(block) -> Dict[str, Any]:
+    """Generic path for blocks that don't have the SDK's usual attributes"""
+    btype = getattr(block, "type", None)
+    if btype == "text":
+        return {"type": "text", "text": getattr(block, "text", "")}
+    if btype == "tool_use":
+        return {
+            "type": "tool_use",
+            "id": getattr(block, "id", None),
+            "name": getattr(block, "name", None),
+            "input": getattr(block, "input", {}) or {},
+        }
+    return {"type": "text", "text": str(block)}
+
+
+_TOOL_USE_FIELDS = operator.attrgetter("id", "name", "input")
+
+
+def _normalize_blocks(content) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """Convert response content to plain dicts; returns (all blocks, computer tool_uses)"""
+    blocks: List[Dict[str, Any]] = []
+    tool_uses: List[Dict[str, Any]] = []
+    for block in content:
+        try:
+            # Fast path: the SDK's TextBlock / ToolUseBlock shapes
+            btype = block.type
+            if btype == "tool_use":
+                tu_id, name, tu_input = _TOOL_USE_FIELDS(block)
+                normalized = {"type": "tool_use", "id": tu_id, "name": name, "input": tu_input or {}}
+            elif btype == "text":
+                normalized = {"type": "text", "text": block.text}
+            else:
+                normalized = {"type": "text", "text": str(block)}
+        except AttributeError:
+            normalized = _normalize_block(block)
+        blocks.append(normalized)
+        if normalized["type"] == "tool_use" and normalized["name"] == "computer":
+            tool_uses.append(normalized)
+    return blocks, tool_uses
+
+
+def _short_input(d: Dict[str, Any]) -> Dict[str, Any]:
+    """Shallow copy of a tool input that is cheap to log: long strings are cut or summarized"""
+    short = {}
+    for k, v in d.items():
+        if isinstance(v, str):
+            if k in ("data", "image") or (k == "text" and len(v) > 200):
+                v = "<len=%d>" % len(v)
+            elif len(v) > 120:
+                v = v[:120] + "..."
+        short[k] = v
+    return short
+
+
+def _coords(tu_input: Dict[str, Any]) -> Tuple[Optional[float], Optional[float]]:
+    """x/y from any of the shapes Claude uses: x/y, position, coordinate(s) arrays"""
+    x = tu_input.get("x") or (tu_input.get("position") or {}).get("x")
+    y = tu_input.get("y") or (tu_input.get("position") or {}).get("y")
+    coord = tu_input.get("coordinate") or tu_input.get("coordinates")
+    if (x is None or y is None) and isinstance(coord, (list, tuple)) and len(coord) >= 2:
+        x, y = coord[0], coord[1]
+    if x is None or y is None:
+        return None, None
+    return float(x), float(y)
+
+
+async def _act_navigate(page, tu_input: Dict[str, Any]) -> str:
+    url = tu_input.get("url") or tu_input.get("value") or tu_input.get("target")
+    if not url:
+        return "no-url"
+    logger.info(f"[CU] navigate → {url}")
+    await page.goto(url, wait_until="domcontentloaded")
+    return "ok"
+
+
+async def _act_click(page, tu_input: Dict[str, Any]) -> str:
+    x, y = _coords(tu_input)
+    if x is None:
+        return "missing-coordinates"
+    logger.info(f"[CU] click at ({x}, {y}) double=False")
+    await page.mouse.move(x, y)
+    await page.mouse.click(x, y)
+    return "ok"
+
+
+async def _act_double_click(page, tu_input: Dict[str, Any]) -> str:
+    x, y = _coords(tu_input)
+    if x is None:
+        return "missing-coordinates"
+    logger.info(f"[CU] click at ({x}, {y}) double=True")
+    await page.mouse.move(x, y)
+    await page.mouse.dblclick(x, y)
+    return "ok"
+
+
+async def _act_right_click(page, tu_input: Dict[str, Any]) -> str:
+    x, y = _coords(tu_input)
+    if x is None:
+        return "missing-coordinates"
+    logger.info(f"[CU] right click at ({x}, {y})")
+    await page.mouse.click(x, y, button="right")
+    return "ok"
+
+
+async def _act_move(page, tu_input: Dict[str, Any]) -> str:
+    x, y = _coords(tu_input)
+    if x is None:
+        return "missing-coordinates"
+    logger.info(f"[CU] move mouse to ({x}, {y})")
+    await page.mouse.move(x, y)
+    return "ok"
+
+
+async def _act_type(page, tu_input: Dict[str, Any]) -> str:
+    text = tu_input.get("text") or tu_input.get("value") or ""
+    logger.info(f"[CU] type text len={len(text)}")
+    await page.keyboard.type(text)
+    return "ok"
+
+
+async def _act_key(page, tu_input: Dict[str, Any]) -> str:
+    # Accept key value from multiple fields commonly seen in Claude outputs
+    key = tu_input.get("key") or tu_input.get("value") or tu_input.get("text") or "Enter"
+    logger.info(f"[CU] press key {key}")
+    await page.keyboard.press(key)
+    return "ok"
+
+
+async def _act_scroll(page, tu_input: Dict[str, Any]) -> str:
+    dx = int(tu_input.get("dx") or 0)
+    dy = int(tu_input.get("dy") or 600)
+    logger.info(f"[CU] scroll wheel dx={dx} dy={dy}")
+    await page.mouse.wheel(dx, dy)
+    return "ok"
+
+
+async def _act_wait(page, tu_input: Dict[str, Any]) -> str:
+    ms = int(tu_input.get("ms") or 1000)
+    logger.info(f"[CU] wait {ms}ms")
+    await page.wait_for_timeout(ms)
+    return "ok"
+
+
+async def _act_back(page, tu_input: Dict[str, Any]) -> str:
+    logger.info("[CU] browser go back")
+    await page.go_back()
+    return "ok"
+
+
+async def _act_forward(page, tu_input: Dict[str, Any]) -> str:
+    logger.info("[CU] browser go forward")
+    await page.go_forward()
+    return "ok"
+
+
+async def _act_reload(page, tu_input: Dict[str, Any]) -> str:
+    logger.info("[CU] browser reload")
+    await page.reload()
+    return "ok"
+
+
+# Computer tool actions (and the aliases Claude uses) to their handlers.
+# "screenshot" is handled in the loop since it produces the tool_result image itself
+_ACTIONS: Dict[str, Callable[[Any, Dict[str, Any]], Awaitable[str]]] = {
+    "navigate": _act_navigate,
+    "goto": _act_navigate,
+    "click": _act_click,
+    "mouse_click": _act_click,
+    "left_click": _act_click,
+    "double_click": _act_double_click,
+    "right_click": _act_right_click,
+    "context_click": _act_right_click,
+    "move_mouse": _act_move,
+    "mouse_move": _act_move,
+    "hover": _act_move,
+    "type": _act_type,
+    "keyboard_type": _act_type,
+    "key": _act_key,
+    "key_press": _act_key,
+    "press": _act_key,
+    "scroll": _act_scroll,
+    "mouse_wheel": _act_scroll,
+    "wait": _act_wait,
+    "back": _act_back,
+    "go_back": _act_back,
+    "forward": _act_forward,
+    "go_forward": _act_forward,
+    "reload": _act_reload,
+    "refresh": _act_reload,
+}
+
+
+async def _safe_title(page) -> Optional[str]:
+    try:
+        return await page.title()
+    except Exception:
+        return None
+
+
+async def _new_browserbase_connector() -> BrowserbaseConnector:
+    """Connect a fresh BrowserbaseConnector"""
+    # Prefer an existing endpoint from env or persisted file, fall back to API creation.
+    ws_ep = os.getenv("BROWSERBASE_WS_ENDPOINT")
+    if not ws_ep:
+        try:
+            persisted_path = _PROJECT_ROOT / ".browserbase_ws_endpoint"
+            if persisted_path.exists():
+                ws_ep = persisted_path.read_text().strip()
+                os.environ["BROWSERBASE_WS_ENDPOINT"] = ws_ep
+                logger.info("Using persisted Browserbase ws_endpoint from .browserbase_ws_endpoint")
+        except Exception:
+            pass
+    if not ws_ep:
+        api_key = os.getenv("BROWSERBASE_API_KEY")
+        if api_key:
+            try:
+                from .dom_agentql_env import AgentQLEnv
+                ws_ep = AgentQLEnv()._create_browserbase_session(api_key)
+                os.environ["BROWSERBASE_WS_ENDPOINT"] = ws_ep
+                logger.info("Created Browserbase session for Computer Use mode via API")
+            except Exception as e:
+                logger.error(f"Failed to create Browserbase session: {e}")
+                # Let connector attempt other fallbacks and raise a clearer error later
+
+    bb = BrowserbaseConnector(timeout=30000, ws_endpoint=ws_ep)
+    await bb.setup(headless=os.getenv("HEADLESS", "true").lower() == "true")
+    return bb
+
+
+class _BBPool:
+    """
+    One idle Browserbase connector kept open between run_browserbase calls, so
+    sequential runs skip the multi-second session setup. Capped at one: every
+    connector attaches to the same persisted/env endpoint and reuses its first
+    context and page, so extra pooled connectors would only be handles on the
+    same remote page. It is reset (cookies cleared, about:blank) on release, but
+    only when no other run holds a connector on that session.
+    """
+
+    def __init__(self):
+        self._idle: Optional[BrowserbaseConnector] = None
+        self._leased = 0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    async def acquire(self) -> BrowserbaseConnector:
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            # Playwright objects are bound to the loop that created them
+            await self._drop_stale()
+            self._leased = 0
+            self._loop = loop
+        self._leased += 1
+        if self._idle is not None:
+            logger.info("[CU] Reusing pooled Browserbase connector")
+            bb, self._idle = self._idle, None
+            return bb
+        try:
+            return await _new_browserbase_connector()
+        except BaseException:
+            self._leased -= 1
+            raise
+
+    async def release(self, bb: BrowserbaseConnector):
+        if asyncio.get_running_loop() is not self._loop:
+            await bb.cleanup()
+            return
+        self._leased -= 1
+        if self._idle is not None or self._leased > 0:
+            # Another run is still on this session; clearing cookies would log it out
+            await bb.cleanup()
+            return
+        try:
+            await bb.context.clear_cookies()
+            await bb.page.goto("about:blank", timeout=5000)
+        except Exception as e:
+            logger.warning(f"[CU] Could not reset Browserbase connector, closing it: {e}")
+            await bb.cleanup()
+            return
+        self._idle = bb
+
+    async def _drop_stale(self):
+        """Release the idle connector left behind by a previous event loop"""
+        bb, self._idle = self._idle, None
+        if bb is None:
+            return
+        old_loop = self._loop
+        if old_loop is not None and old_loop.is_running():
+            asyncio.run_coroutine_threadsafe(bb.cleanup(), old_loop)
+        else:
+            logger.warning(
+                "[CU] Idle Browserbase connector outlived its event loop and could not be "
+                "closed; await close_browserbase_pool() before the loop shuts down"
+            )
+
+    async def close(self):
+        bb, self._idle = self._idle, None
+        if bb is not None:
+            await bb.cleanup()
+
+
+_BB_POOL = _BBPool()
+
+
+async def close_browserbase_pool():
+    """Clean up the idle pooled connector; call before the event loop shuts down"""
+    await _BB_POOL.close()
+
 
 class AnthropicComputerUseRunner:
     """
@@ -26,13 +451,13 @@ class AnthropicComputerUseRunner:
     """
 
     def __init__(self, model: Optional[str] = None):
+        global _DOTENV_LOADED
         api_key = os.getenv("ANTHROPIC_API_KEY")
-        if not api_key:
-            # Attempt to load from project-level .env
+        if not api_key and not _DOTENV_LOADED:
+            # Attempt to load from project-level .env, at most once per process
+            _DOTENV_LOADED = True
             try:
-                project_root = Path(__file__).resolve().parents[3]
-                dotenv_path = project_root / ".env"
-                load_dotenv(dotenv_path=dotenv_path, override=False)
+                load_dotenv(dotenv_path=_DOTENV_PATH, override=False)
             except Exception:
                 pass
             api_key = os.getenv("ANTHROPIC_API_KEY")
@@ -48,6 +473,10 @@ class AnthropicComputerUseRunner:
         if not api_key:
             raise RuntimeError("ANTHROPIC_API_KEY is required for Anthropic Computer Use.")
         self.client = anthropic.Anthropic(api_key=api_key)
+        # The Browserbase loop awaits the model so trace writes can overlap the request
+        self.async_client = anthropic.AsyncAnthropic(api_key=api_key)
+        # Output tokens of recent loop turns, for sizing max_tokens
+        self._output_tokens: Deque[int] = deque(maxlen=20)
         # Prefer explicit model via env/argument; default to Claude Sonnet 4 sample from docs
         self.model = model or os.getenv("ANTHROPIC_COMPUTER_USE_MODEL") or "claude-sonnet-4-20250514"
 
@@ -58,34 +487,48 @@ class AnthropicComputerUseRunner:
             "target_url": target_url,
         }
         beta_tag = os.getenv("ANTHROPIC_COMPUTER_USE_BETA", "computer-use-2025-01-24")
+        params = {
+            "model": self.model,
+            "max_tokens": 1024,
+            "tools": [
+                {
+                    "type": "computer_20250124",
+                    "name": "computer",
+                    "display_width_px": 1024,
+                    "display_height_px": 768,
+                    "display_number": 1,
+                },
+            ],
+            "messages": [{"role": "user", "content": _dumps(instruction)}],
+            "betas": [beta_tag],
+            "system": SHOPPER_SYSTEM_PROMPT,
+        }
+        # Identical single-shot requests get the same answer; reuse it across runs
+        cache_path = None
+        if os.getenv("UXAGENT_LLM_CACHE", "1") == "1":
+            key = hashlib.sha256(json.dumps(params, sort_keys=True).encode("utf-8")).hexdigest()
+            cache_path = LLM_CACHE_DIR / f"{key}.json"
+            try:
+                payload = json.loads(cache_path.read_text())
+                logger.info("Using cached Anthropic response")
+                return {"success": True, "provider": "anthropic", "api": "beta.messages", "payload": payload}
+            except Exception:
+                pass
         # Preferred: beta messages with explicit computer-use beta flag
         try:
-            resp = self.client.beta.messages.create(
-                model=self.model,
-                max_tokens=1024,
-                tools=[
-                    {
-                        "type": "computer_20250124",
-                        "name": "computer",
-                        "display_width_px": 1024,
-                        "display_height_px": 768,
-                        "display_number": 1,
-                    },
-                ],
-                messages=[{"role": "user", "content": json.dumps(instruction)}],
-                betas=[beta_tag],
-                system=(
-                    "You are a shopper who is looking to purchase something on a website. "
-                    "Control the browser only via the computer tool. "
-                    "Before acting and after each action, request and review a screenshot. "
-                    "Use precise clicks and short waits. Avoid destructive actions. "
-                    "When the goal is complete, stop issuing tool_use."
-                ),
-            )
+            resp = self.client.beta.messages.create(**params)
             try:
                 payload = resp.model_dump()
             except Exception:
-                payload = json.loads(json.dumps(resp, default=str))
+                payload = json.loads(_dumps(resp, default=str))
+            if cache_path is not None:
+                try:
+                    LLM_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+                    tmp_path = cache_path.with_suffix(f".{os.getpid()}.tmp")
+                    tmp_path.write_text(_dumps(payload, default=str))
+                    os.replace(tmp_path, cache_path)
+                except Exception as e:
+                    logger.warning(f"Failed to cache Anthropic response: {e}")
             return {"success": True, "provider": "anthropic", "api": "beta.messages", "payload": payload}
         except Exception as e:
             logger.error(f"Anthropic Computer Use error (beta.messages): {e}")
@@ -103,25 +546,136 @@ class AnthropicComputerUseRunner:
                             "display_number": 1,
                         }
                     ],
-                    messages=[{"role": "user", "content": json.dumps(instruction)}],
+                    messages=[{"role": "user", "content": _dumps(instruction)}],
                     betas=[beta_tag],
-                    system=(
-                        "You are a shopper who is looking to purchase something on a website. "
-                        "Control the browser only via the computer tool. "
-                        "Before acting and after each action, request and review a screenshot. "
-                        "Use precise clicks and short waits. Avoid destructive actions. "
-                        "When the goal is complete, stop issuing tool_use."
-                    ),
+                    system=SHOPPER_SYSTEM_PROMPT,
                 )
                 try:
                     payload2 = resp2.model_dump()
                 except Exception:
-                    payload2 = json.loads(json.dumps(resp2, default=str))
+                    payload2 = json.loads(_dumps(resp2, default=str))
                 return {"success": True, "provider": "anthropic", "api": "messages", "payload": payload2}
             except Exception as e2:
                 logger.error(f"Anthropic Computer Use error (messages): {e2}")
                 return {"success": False, "error": str(e2)}
 
+    async def run_many(self, instructions: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Single-shot run() for many {persona, goal, target_url} dicts via the Message Batches API.
+
+        Batches are billed at a discount and have their own rate limits, which suits
+        bulk persona sweeps. Results come back in input order. Falls back to per-item
+        run() when the batch endpoint is unavailable for the configured model.
+        """
+        if not instructions:
+            return []
+        beta_tag = os.getenv("ANTHROPIC_COMPUTER_USE_BETA", "computer-use-2025-01-24")
+        requests = [
+            {
+                "custom_id": str(i),
+                "params": {
+                    "model": self.model,
+                    "max_tokens": 1024,
+                    "tools": [
+                        {
+                            "type": "computer_20250124",
+                            "name": "computer",
+                            "display_width_px": 1024,
+                            "display_height_px": 768,
+                            "display_number": 1,
+                        },
+                    ],
+                    "messages": [{"role": "user", "content": _dumps({
+                        "persona": ins.get("persona"),
+                        "goal": ins.get("goal"),
+                        "target_url": ins.get("target_url"),
+                    })}],
+                    "system": SHOPPER_SYSTEM_PROMPT,
+                },
+            }
+            for i, ins in enumerate(instructions)
+        ]
+        batches = self.async_client.beta.messages.batches
+        try:
+            batch = await batches.create(requests=requests, betas=[beta_tag])
+        except anthropic.NotFoundError as e:
+            logger.warning(f"Message Batches unavailable ({e}); running {len(instructions)} requests one by one")
+            return [
+                await asyncio.to_thread(self.run, ins.get("persona"), ins.get("goal"), ins.get("target_url"))
+                for ins in instructions
+            ]
+        logger.info(f"Submitted message batch {batch.id} with {len(requests)} requests")
+
+        delay = 5.0
+        while batch.processing_status != "ended":
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30.0)
+            batch = await batches.retrieve(batch.id, betas=[beta_tag])
+
+        results: List[Dict[str, Any]] = [
+            {"success": False, "error": "missing from batch results"} for _ in instructions
+        ]
+        async for entry in await batches.results(batch.id, betas=[beta_tag]):
+            result = entry.result
+            if result.type == "succeeded":
+                results[int(entry.custom_id)] = {
+                    "success": True,
+                    "provider": "anthropic",
+                    "api": "beta.messages.batches",
+                    "payload": result.message.model_dump(),
+                }
+            else:
+                error = getattr(result, "error", None)
+                results[int(entry.custom_id)] = {
+                    "success": False,
+                    "error": str(error) if error is not None else result.type,
+                }
+        return results
+
+    def _step_max_tokens(self) -> int:
+        """max_tokens for the next loop turn: 1.5x the recent p95, within [64, STEP_MAX_TOKENS]"""
+        if len(self._output_tokens) < 5:
+            return STEP_MAX_TOKENS
+        ordered = sorted(self._output_tokens)
+        p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+        return min(STEP_MAX_TOKENS, max(64, int(p95 * 1.5)))
+
+    async def _create_step(self, on_tool_use: Optional[Callable[[Dict[str, Any]], None]] = None, **params):
+        """Stream one loop message; returns (message, seconds to wait before the next request).
+
+        on_tool_use is called with each computer tool_use as soon as its input is known
+        to be complete, while the rest of the turn is still generating. A 429 is
+        retried once after the server's retry-after.
+        """
+        try:
+            return await self._stream_step(on_tool_use, params)
+        except anthropic.RateLimitError as e:
+            try:
+                retry_after = float(e.response.headers.get("retry-after", "2"))
+            except (TypeError, ValueError):
+                retry_after = 2.0
+            logger.warning(f"[CU] Rate limited, retrying in {retry_after}s")
+            await asyncio.sleep(retry_after)
+            return await self._stream_step(on_tool_use, params)
+
+    async def _stream_step(self, on_tool_use, params):
+        # A finished tool_use is only handed over once the next block starts or the turn
+        # ends normally: a block cut off by max_tokens also gets a content_block_stop
+        pending = None
+        async with self.async_client.beta.messages.stream(**params) as stream:
+            async for event in stream:
+                if on_tool_use is None:
+                    continue
+                if event.type == "content_block_stop":
+                    _, tool_uses = _normalize_blocks([stream.current_message_snapshot.content[event.index]])
+                    pending = tool_uses[0] if tool_uses else None
+                elif event.type in ("content_block_start", "message_delta") and pending is not None:
+                    if event.type == "content_block_start" or event.delta.stop_reason != "max_tokens":
+                        on_tool_use(pending)
+                    pending = None
+            message = await stream.get_final_message()
+            headers = stream.response.headers
+        return message, _throttle_delay(headers)
+
     async def run_browserbase(self, persona: str, goal: str, target_url: str, output_dir: str, max_steps: int = 40) -> Dict[str, Any]:
         """Execute Anthropic Computer Use tool actions against a Browserbase browser via Playwright.
 
@@ -129,46 +683,31 @@ class AnthropicComputerUseRunner:
         """
         beta_tag = os.getenv("ANTHROPIC_COMPUTER_USE_BETA", "computer-use-2025-01-24")
 
-        # Setup Browserbase
-        # Prefer an existing endpoint from env or persisted file, fall back to API creation.
-        ws_ep = os.getenv("BROWSERBASE_WS_ENDPOINT")
-        if not ws_ep:
-            try:
-                persisted_path = Path(__file__).resolve().parents[3] / ".browserbase_ws_endpoint"
-                if persisted_path.exists():
-                    ws_ep = persisted_path.read_text().strip()
-                    os.environ["BROWSERBASE_WS_ENDPOINT"] = ws_ep
-                    logger.info("Using persisted Browserbase ws_endpoint from .browserbase_ws_endpoint")
-            except Exception:
-                pass
-        if not ws_ep:
-            api_key = os.getenv("BROWSERBASE_API_KEY")
-            if api_key:
-                try:
-                    from .dom_agentql_env import AgentQLEnv
-                    ws_ep = AgentQLEnv()._create_browserbase_session(api_key)
-                    os.environ["BROWSERBASE_WS_ENDPOINT"] = ws_ep
-                    logger.info("Created Browserbase session for Computer Use mode via API")
-                except Exception as e:
-                    logger.error(f"Failed to create Browserbase session: {e}")
-                    # Let connector attempt other fallbacks and raise a clearer error later
-
-        bb = BrowserbaseConnector(timeout=30000, ws_endpoint=ws_ep)
-        await bb.setup(headless=os.getenv("HEADLESS", "true").lower() == "true")
+        # Setup Browserbase, reusing a pooled connector when one is idle
+        bb = await _BB_POOL.acquire()
         # Align viewport with advertised display size
         try:
             await bb.page.set_viewport_size({"width": 1280, "height": 800})
         except Exception:
             pass
         screens_dir = Path(output_dir) / "screens"
-        screens_dir.mkdir(parents=True, exist_ok=True)
+        # CU_TRACE=0 skips writing per-step screenshots to disk
+        trace = os.getenv("CU_TRACE", "1") != "0"
+        if trace:
+            screens_dir.mkdir(parents=True, exist_ok=True)
+        # Screenshot writes run in threads, overlapping the next model request
+        trace_writes: List[asyncio.Task] = []
 
         # Navigate initial URL if provided
         if target_url:
-            try:
-                await bb.page.goto("about:blank", timeout=5000)
-            except Exception:
-                pass
+            # Pooled connectors are already parked on about:blank, and a same-origin
+            # target doesn't need the reset
+            current = bb.page.url
+            if current != "about:blank" and urlparse(current).netloc != urlparse(target_url).netloc:
+                try:
+                    await bb.page.goto("about:blank", timeout=5000)
+                except Exception:
+                    pass
             logger.info(f"[CU] Navigating to initial target URL: {target_url}")
             await bb.page.goto(target_url, wait_until="domcontentloaded")
             try:
@@ -181,31 +720,118 @@ class AnthropicComputerUseRunner:
                 title_now = None
             logger.info(f"[CU] At URL: {bb.page.url} | Title: {title_now}")
 
-        # Transcript history
+        # Transcript history. Append-only: earlier turns must stay byte-identical for prompt caching
         history: List[Dict[str, Any]] = [
             {
                 "role": "user",
-                "content": json.dumps({
-                    "persona": persona,
-                    "goal": goal,
-                    "target_url": target_url,
-                }),
+                "content": [
+                    {
+                        "type": "text",
+                        "text": _dumps({
+                            "persona": persona,
+                            "goal": goal,
+                            "target_url": target_url,
+                        }),
+                    }
+                ],
             }
         ]
 
-        def build_tools() -> List[Dict[str, Any]]:
-            return [
-                {
-                    "type": "computer_20250124",
-                    "name": "computer",
-                    "display_width_px": 1280,
-                    "display_height_px": 800,
-                    "display_number": 1,
-                },
-            ]
-
         step = 0
         results: List[Dict[str, Any]] = []
+        # Indices of history turns that still carry screenshots
+        image_turns: List[int] = []
+
+        async def execute_tool_use(tu: Dict[str, Any]) -> Dict[str, Any]:
+            """Run one computer tool_use against the page and build its tool_result"""
+            nonlocal step, trace_writes
+            tu_id = tu.get("id")
+            tu_input = tu.get("input", {}) or {}
+            action = (tu_input.get("action") or "").lower()
+            result_text = "ok"
+            shot_bytes = None
+            media_type = SCREENSHOT_MEDIA_TYPE
+
+            try:
+                if logger.isEnabledFor(logging.INFO):
+                    logger.info(
+                        "[CU] Executing tool_use id=%s action=%s input=%s",
+                        tu_id, action, _dumps(_short_input(tu_input)),
+                    )
+                if action == "screenshot":
+                    if SCREENSHOT_LOSSLESS:
+                        shot_bytes = await bb.page.screenshot(full_page=False, type="png")
+                        media_type = "image/png"
+                    else:
+                        shot_bytes = await bb.page.screenshot(**SCREENSHOT_OPTIONS)
+                else:
+                    handler = _ACTIONS.get(action)
+                    result_text = await handler(bb.page, tu_input) if handler else f"unsupported-action:{action}"
+
+                # After each visual action, capture a small screenshot for trace,
+                # reading the title for the log line in the same round of CDP calls
+                if shot_bytes is None and action in NEEDS_VISUAL:
+                    try:
+                        await bb.page.wait_for_timeout(200)
+                    except Exception:
+                        pass
+                    shot_bytes, cur_title_after = await asyncio.gather(
+                        bb.page.screenshot(**SCREENSHOT_OPTIONS), _safe_title(bb.page)
+                    )
+                else:
+                    cur_title_after = await _safe_title(bb.page)
+                # Save to disk
+                step += 1
+                shot_path = (
+                    screens_dir / f"step_{step:03d}.{media_type.split('/')[1]}"
+                    if trace and shot_bytes is not None else None
+                )
+                if shot_path is not None:
+                    trace_writes = [t for t in trace_writes if not t.done()]
+                    trace_writes.append(
+                        asyncio.create_task(asyncio.to_thread(shot_path.write_bytes, shot_bytes))
+                    )
+
+                logger.info(
+                    f"[CU] Completed action={action} status={result_text} → URL: {bb.page.url} | Title: {cur_title_after} | Screenshot: {shot_path}"
+                )
+
+                # Append tool_result, with an image only when one was captured
+                content: List[Dict[str, Any]] = [{"type": "text", "text": result_text}]
+                if shot_bytes is not None:
+                    content.insert(0, {
+                        "type": "image",
+                        "source": {
+                            "type": "base64",
+                            "media_type": media_type,
+                            "data": _b64encode(shot_bytes).decode("ascii"),
+                        },
+                    })
+                results.append({
+                    "action": action,
+                    "status": result_text,
+                    "screenshot": str(shot_path) if shot_path else None,
+                })
+                return {
+                    "type": "tool_result",
+                    "tool_use_id": tu_id,
+                    "content": content,
+                }
+            except Exception as exec_err:
+                # Return an error tool_result
+                logger.exception(f"[CU] Error executing action={action}: {exec_err}")
+                results.append({"action": action, "status": f"error:{exec_err}"})
+                return {
+                    "type": "tool_result",
+                    "tool_use_id": tu_id,
+                    "content": [{"type": "text", "text": f"error:{exec_err}"}],
+                }
+
+        async def execute_after(previous: Optional[asyncio.Task], tu: Dict[str, Any]) -> Dict[str, Any]:
+            if previous is not None:
+                await asyncio.wait([previous])
+            return await execute_tool_use(tu)
+
         try:
             while step < max_steps:
                 # Create / continue the conversation
@@ -214,40 +840,49 @@ class AnthropicComputerUseRunner:
                 except Exception:
                     cur_title = None
                 logger.info(f"[CU] Step {step + 1} of {max_steps} | URL: {bb.page.url} | Title: {cur_title}")
-                resp = self.client.beta.messages.create(
+                _mark_cache_breakpoint(history)
+                step_params = dict(
                     model=self.model,
-                    max_tokens=256,
-                    tools=build_tools(),
+                    max_tokens=self._step_max_tokens(),
+                    tools=list(_CU_TOOLS),
                     messages=history,
-                    betas=[beta_tag],
-                    system=(
-                        "You are a shopper who is looking to purchase something on a website. "
-                        "Control the browser only via the computer tool. "
-                        "Before acting and after each action, request and review a screenshot. "
-                        "Use precise clicks and short waits. Avoid destructive actions. "
-                        "When the goal is complete, stop issuing tool_use."
-                    ),
+                    betas=[beta_tag, PROMPT_CACHING_BETA],
+                    system=SHOPPER_SYSTEM_PROMPT,
                 )
+                # Actions start while the turn is still streaming, chained to run in order
+                dispatched: List[asyncio.Task] = []
+
+                def dispatch(tu: Dict[str, Any]):
+                    previous = dispatched[-1] if dispatched else None
+                    dispatched.append(asyncio.create_task(execute_after(previous, tu)))
+
+                try:
+                    resp, throttle = await self._create_step(on_tool_use=dispatch, **step_params)
+                    if (
+                        getattr(resp, "stop_reason", None) == "max_tokens"
+                        and step_params["max_tokens"] < STEP_MAX_TOKENS
+                        and not dispatched
+                    ):
+                        # The adaptive cap cut the turn short before any action; redo it with the full budget
+                        logger.info(f"[CU] Turn hit max_tokens={step_params['max_tokens']}, retrying with {STEP_MAX_TOKENS}")
+                        step_params["max_tokens"] = STEP_MAX_TOKENS
+                        resp, throttle = await self._create_step(on_tool_use=dispatch, **step_params)
+                except Exception:
+                    await asyncio.gather(*dispatched, return_exceptions=True)
+                    raise
+
+                usage = getattr(resp, "usage", None)
+                if usage is not None:
+                    if isinstance(getattr(usage, "output_tokens", None), int):
+                        self._output_tokens.append(usage.output_tokens)
+                    logger.info(
+                        f"[CU] Tokens: input={getattr(usage, 'input_tokens', None)} "
+                        f"cache_read={getattr(usage, 'cache_read_input_tokens', None)} "
+                        f"cache_write={getattr(usage, 'cache_creation_input_tokens', None)}"
+                    )
 
                 # Normalize assistant content blocks and extract tool_uses
-                assistant_blocks: List[Dict[str, Any]] = []
-                tool_uses: List[Dict[str, Any]] = []
-                for block in resp.content:
-                    btype = getattr(block, "type", None)
-                    if btype == "text":
-                        assistant_blocks.append({"type": "text", "text": getattr(block, "text", "")})
-                    elif btype == "tool_use":
-                        normalized = {
-                            "type": "tool_use",
-                            "id": getattr(block, "id", None),
-                            "name": getattr(block, "name", None),
-                            "input": getattr(block, "input", {}) or {},
-                        }
-                        assistant_blocks.append(normalized)
-                        if normalized.get("name") == "computer":
-                            tool_uses.append(normalized)
-                    else:
-                        assistant_blocks.append({"type": "text", "text": str(block)})
+                assistant_blocks, tool_uses = _normalize_blocks(resp.content)
 
                 # Log assistant decision
                 if tool_uses:
@@ -275,163 +910,38 @@ class AnthropicComputerUseRunner:
                         "steps": results,
                     }
 
-                # For each tool_use, execute and prepare tool_result content blocks
-                tool_result_blocks: List[Dict[str, Any]] = []
+                # Each complete tool_use was already started while the turn streamed in;
+                # collect their tool_results in order
+                tool_result_blocks = [await task for task in dispatched]
+                started = {block["tool_use_id"] for block in tool_result_blocks}
                 for tu in tool_uses:
-                    tu_id = tu.get("id")
-                    tu_input = tu.get("input", {}) or {}
-                    action = (tu_input.get("action") or "").lower()
-                    result_text = "ok"
-                    img_b64 = None
-
-                    try:
-                        logger.info(f"[CU] Executing tool_use id={tu_id} action={action} input={json.dumps(tu_input)[:500]}")
-                        if action == "screenshot":
-                            png = await bb.page.screenshot(full_page=False)
-                            img_b64 = base64.b64encode(png).decode("ascii")
-                        elif action in ("navigate", "goto"):
-                            url = tu_input.get("url") or tu_input.get("value") or tu_input.get("target")
-                            if url:
-                                logger.info(f"[CU] navigate → {url}")
-                                await bb.page.goto(url, wait_until="domcontentloaded")
-                            else:
-                                result_text = "no-url"
-                        elif action in ("click", "mouse_click", "double_click", "left_click"):
-                            x = tu_input.get("x") or (tu_input.get("position") or {}).get("x")
-                            y = tu_input.get("y") or (tu_input.get("position") or {}).get("y")
-                            # Claude may provide coordinates as an array under 'coordinate' or 'coordinates'
-                            coord = tu_input.get("coordinate") or tu_input.get("coordinates")
-                            if (x is None or y is None) and isinstance(coord, (list, tuple)) and len(coord) >= 2:
-                                x = coord[0]
-                                y = coord[1]
-                            if x is not None and y is not None:
-                                logger.info(f"[CU] click at ({x}, {y}) double={action=='double_click'}")
-                                await bb.page.mouse.move(float(x), float(y))
-                                if action == "double_click":
-                                    await bb.page.mouse.dblclick(float(x), float(y))
-                                else:
-                                    await bb.page.mouse.click(float(x), float(y))
-                            else:
-                                result_text = "missing-coordinates"
-                        elif action in ("move_mouse", "mouse_move"):
-                            x = tu_input.get("x") or (tu_input.get("position") or {}).get("x")
-                            y = tu_input.get("y") or (tu_input.get("position") or {}).get("y")
-                            if x is not None and y is not None:
-                                logger.info(f"[CU] move mouse to ({x}, {y})")
-                                await bb.page.mouse.move(float(x), float(y))
-                            else:
-                                result_text = "missing-coordinates"
-                        elif action in ("right_click", "context_click"):
-                            x = tu_input.get("x") or (tu_input.get("position") or {}).get("x")
-                            y = tu_input.get("y") or (tu_input.get("position") or {}).get("y")
-                            coord = tu_input.get("coordinate") or tu_input.get("coordinates")
-                            if (x is None or y is None) and isinstance(coord, (list, tuple)) and len(coord) >= 2:
-                                x = coord[0]
-                                y = coord[1]
-                            if x is not None and y is not None:
-                                logger.info(f"[CU] right click at ({x}, {y})")
-                                await bb.page.mouse.click(float(x), float(y), button="right")
-                            else:
-                                result_text = "missing-coordinates"
-                        elif action in ("hover",):
-                            x = tu_input.get("x") or (tu_input.get("position") or {}).get("x")
-                            y = tu_input.get("y") or (tu_input.get("position") or {}).get("y")
-                            if x is not None and y is not None:
-                                logger.info(f"[CU] hover at ({x}, {y})")
-                                await bb.page.mouse.move(float(x), float(y))
-                            else:
-                                result_text = "missing-coordinates"
-                        elif action in ("type", "keyboard_type"):
-                            text = tu_input.get("text") or tu_input.get("value") or ""
-                            logger.info(f"[CU] type text len={len(text)}")
-                            await bb.page.keyboard.type(text)
-                        elif action in ("key", "key_press", "press"):
-                            # Accept key value from multiple fields commonly seen in Claude outputs
-                            key = tu_input.get("key") or tu_input.get("value") or tu_input.get("text") or "Enter"
-                            logger.info(f"[CU] press key {key}")
-                            await bb.page.keyboard.press(key)
-                        elif action in ("scroll", "mouse_wheel"):
-                            dx = int(tu_input.get("dx") or 0)
-                            dy = int(tu_input.get("dy") or 600)
-                            logger.info(f"[CU] scroll wheel dx={dx} dy={dy}")
-                            await bb.page.mouse.wheel(dx, dy)
-                        elif action == "wait":
-                            ms = int(tu_input.get("ms") or 1000)
-                            logger.info(f"[CU] wait {ms}ms")
-                            await bb.page.wait_for_timeout(ms)
-                        elif action in ("back", "go_back"):
-                            logger.info("[CU] browser go back")
-                            await bb.page.go_back()
-                        elif action in ("forward", "go_forward"):
-                            logger.info("[CU] browser go forward")
-                            await bb.page.go_forward()
-                        elif action in ("reload", "refresh"):
-                            logger.info("[CU] browser reload")
-                            await bb.page.reload()
-                        else:
-                            result_text = f"unsupported-action:{action}"
-
-                        # After each action, capture a small screenshot for trace
-                        try:
-                            await bb.page.wait_for_timeout(200)
-                        except Exception:
-                            pass
-                        if img_b64 is None:
-                            png2 = await bb.page.screenshot(full_page=False)
-                            img_b64 = base64.b64encode(png2).decode("ascii")
-                        # Save to disk
-                        step += 1
-                        shot_path = screens_dir / f"step_{step:03d}.png"
-                        shot_path.write_bytes(base64.b64decode(img_b64))
-
-                        try:
-                            cur_title_after = await bb.page.title()
-                        except Exception:
-                            cur_title_after = None
-                        logger.info(
-                            f"[CU] Completed action={action} status={result_text} → URL: {bb.page.url} | Title: {cur_title_after} | Screenshot: {shot_path}"
-                        )
-
-                        # Append tool_result with image
-                        tool_result_blocks.append(
-                            {
-                                "type": "tool_result",
-                                "tool_use_id": tu_id,
-                                "content": [
-                                    {
-                                        "type": "image",
-                                        "source": {
-                                            "type": "base64",
-                                            "media_type": "image/png",
-                                            "data": img_b64,
-                                        },
-                                    },
-                                    {"type": "text", "text": result_text},
-                                ],
-                            }
-                        )
-
-                        results.append({"action": action, "status": result_text, "screenshot": str(shot_path)})
-                    except Exception as exec_err:
-                        # Return an error tool_result
-                        logger.exception(f"[CU] Error executing action={action}: {exec_err}")
-                        tool_result_blocks.append(
-                            {
-                                "type": "tool_result",
-                                "tool_use_id": tu_id,
-                                "content": [{"type": "text", "text": f"error:{exec_err}"}],
-                            }
-                        )
-                        results.append({"action": action, "status": f"error:{exec_err}"})
+                    if tu.get("id") not in started:
+                        # Cut off by max_tokens before its input was complete
+                        tool_result_blocks.append({
+                            "type": "tool_result",
+                            "tool_use_id": tu.get("id"),
+                            "content": [{"type": "text", "text": "error:truncated"}],
+                        })
 
                 # Append our user tool_result turn and continue
                 history.append({"role": "user", "content": tool_result_blocks})
-                # Gentle throttle to avoid 429 rate limits
-                await asyncio.sleep(1.5)
+                if any(
+                    b.get("type") == "image"
+                    for tr in tool_result_blocks
+                    for b in tr.get("content", [])
+                ):
+                    image_turns.append(len(history) - 1)
+                    _evict_screenshots(history, image_turns)
+                # Throttle only as much as the remaining rate-limit budget calls for
+                if throttle > 0:
+                    logger.info(f"[CU] Rate limit nearly used up, waiting {throttle:.2f}s")
+                    await asyncio.sleep(throttle)
 
             # If loop exits
             return {"success": True, "provider": "anthropic", "api": "beta.messages.loop", "steps": results}
         finally:
-            await bb.cleanup()
+            if trace_writes:
+                await asyncio.gather(*trace_writes, return_exceptions=True)
+            await _BB_POOL.release(bb)
 
 
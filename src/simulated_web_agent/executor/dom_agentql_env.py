@@ -1,21 +1,227 @@
 import asyncio
+import contextlib
+import functools
+import hashlib
 import json
 import logging
 import os
+import re
 import time
 import traceback
-from typing import Any, Dict, List, Optional, Union
-from urllib.parse import urljoin, urlparse
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple, Union
+from urllib.parse import urljoin
 import requests
 
 import agentql
-from playwright.async_api import async_playwright, Browser, BrowserContext, Page
+from playwright.async_api import async_playwright, Browser, BrowserContext, Locator, Page
 from playwright_stealth import stealth_async
 
 # Import existing components
 from ..agent import context
 from pathlib import Path
 
+# Resolved selectors learned from AgentQL, replayed on an identical DOM
+SCHEMA_CACHE_PATH = Path.home() / ".cache" / "uxagent" / "schema_cache.json"
+SCHEMA_CACHE_TTL = 7 * 24 * 3600
+# Fields older versions stored that carry persona-typed text; replay needs neither
+_SCHEMA_CACHE_PRIVATE_FIELDS = ("action", "value")
+
+# Digest of the body HTML for schema-cache keys, computed in the page so only a short
+# string crosses CDP. Attributes that change between renders of the same page are
+# dropped and digits in generated ids masked first; cyrb53 gives a 53-bit hash.
+_DOM_FINGERPRINT_JS = r"""
+() => {
+    const html = (document.body ? document.body.outerHTML : '')
+        .replace(/\s(?:data-reactid|data-react-checksum|nonce)="[^"]*"/g, '')
+        .replace(/\s(id|for|aria-labelledby|aria-controls)="([^"]*\d[^"]*)"/g,
+                 (m, attr, value) => ` ${attr}="${value.replace(/\d+/g, '#')}"`);
+    let h1 = 0xdeadbeef, h2 = 0x41c6ce57;
+    for (let i = 0; i < html.length; i++) {
+        const ch = html.charCodeAt(i);
+        h1 = Math.imul(h1 ^ ch, 2654435761);
+        h2 = Math.imul(h2 ^ ch, 1597334677);
+    }
+    h1 = Math.imul(h1 ^ (h1 >>> 16), 2246822507) ^ Math.imul(h2 ^ (h2 >>> 13), 3266489909);
+    h2 = Math.imul(h2 ^ (h2 >>> 16), 2246822507) ^ Math.imul(h1 ^ (h1 >>> 13), 3266489909);
+    return (4294967296 * (2097151 & h2) + (h1 >>> 0)).toString(36) + ':' + html.length;
+}
+"""
+
+_SLUG_RE = re.compile(r'[^a-zA-Z0-9_]')
+# Keyword routing for execute_action. Submit and select phrases win wherever they
+# appear before a "with <value>" clause, so "type coffee and press enter" submits and
+# "select size from dropdown" reaches the select handler, while the typed text in
+# 'fill notes with "dropdown"' is ignored. Otherwise the leftmost action verb decides.
+_WITH_RE = re.compile(r'\bwith\b', re.IGNORECASE)
+_SUBMIT_RE = re.compile(r'press enter|submit search|^\s*submit\s*$', re.IGNORECASE)
+_SELECT_RE = re.compile(r'\b(?:dropdown|choose option)\b', re.IGNORECASE)
+_VERB_ROUTE_RE = re.compile(
+    r'\b(?P<input>fill|type|enter|input|write)\b'
+    r'|\b(?P<nav>scroll|navigate|go to)\b'
+    r'|\b(?P<click>click|tap|press|select|choose)\b',
+    re.IGNORECASE
+)
+# Leading verb of an instruction, e.g. "click on the" in "click on the Add to Cart button"
+_ACTION_VERB_RE = re.compile(r'^\s*(?:click|tap|press|select|choose)\s+(?:on\s+)?(?:the\s+)?', re.IGNORECASE)
+
+
+def _route_instruction(instruction: str) -> Optional[str]:
+    """Handler name for an instruction, or None for the generic handler"""
+    head = _WITH_RE.split(instruction, 1)[0]
+    if _SUBMIT_RE.search(head):
+        return "submit"
+    if _SELECT_RE.search(head):
+        return "select"
+    match = _VERB_ROUTE_RE.search(instruction)
+    return match.lastgroup if match else None
+
+
+def _write_schema_cache(cache: Dict[str, Any]):
+    """Atomically replace the schema cache file, readable only by the owner"""
+    SCHEMA_CACHE_PATH.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+    tmp_path = SCHEMA_CACHE_PATH.with_suffix(f".{os.getpid()}.tmp")
+    fd = os.open(tmp_path, os.O_CREAT | os.O_WRONLY | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as f:
+        # O_CREAT's mode only applies to new files; tighten a leftover tmp file
+        os.fchmod(f.fileno(), 0o600)
+        f.write(json.dumps(cache))
+    os.replace(tmp_path, SCHEMA_CACHE_PATH)
+
+
+def _parse_fill(instruction_str: str) -> Tuple[str, str]:
+    """Split 'fill <field> with <value>' into (field description, value)"""
+    parts = instruction_str.split("with")
+    field_desc = parts[0].replace("fill", "").strip()
+    value = parts[1].strip() if len(parts) > 1 else ""
+    # Strip wrapping quotes if present
+    if (value.startswith('"') and value.endswith('"')) or (value.startswith("'") and value.endswith("'")):
+        value = value[1:-1]
+    # Clean up the description
+    field_desc = field_desc.replace('"', '').replace("'", "").replace(":", "")
+    return field_desc, value
+
+
+@functools.lru_cache(maxsize=1024)
+def _agentql_slug(desc: str) -> str:
+    """Turn a natural-language description into an AgentQL field name"""
+    return _SLUG_RE.sub('', desc.lower().replace(" ", "_").replace("-", "_"))
+
+
+@functools.lru_cache(maxsize=1024)
+def _wrap_query(slug: str) -> str:
+    """Wrap a single field name in AgentQL query syntax"""
+    return "{\n    %s\n}" % slug
+
+
+# Resource types aborted when block_assets is on. Stylesheets are kept because
+# element visibility (and so locator matching) depends on them.
+_BLOCKED_RESOURCE_TYPES = frozenset({"image", "font", "media"})
+
+# Ad/analytics hosts aborted by the context route handler. Every request passes
+# through the handler, so the list is matched with one compiled alternation
+# instead of a substring scan per domain.
+_BLOCKED_DOMAINS = (
+    'googlesyndication.com',
+    'doubleclick.net',
+    'g.doubleclick.net',
+    'google-analytics.com',
+    'googletagmanager.com',
+    'facebook.net',
+    'google.com/recaptcha',
+    'safeframe.googlesyndication.com',
+    'adservice.google.com',
+)
+_BLOCKED_URL_RE = re.compile('|'.join(map(re.escape, _BLOCKED_DOMAINS)), re.IGNORECASE)
+
+
+def _ensure_str_instruction(fn):
+    """Coerce the instruction argument of an action handler to a string.
+
+    LLM-planned steps sometimes arrive as dicts; use their instruction/text/action
+    field when present.
+    """
+    @functools.wraps(fn)
+    async def wrapper(self, instruction, *args, **kwargs):
+        if isinstance(instruction, dict):
+            converted = str(
+                instruction.get('instruction') or instruction.get('text')
+                or instruction.get('action') or instruction
+            )
+            self.logger.warning(f"Received dictionary instead of string for instruction, converted: {converted}")
+            instruction = converted
+        elif not isinstance(instruction, str):
+            converted = str(instruction)
+            self.logger.warning(f"Received {type(instruction)} instead of string for instruction, converted: {converted}")
+            instruction = converted
+        return await fn(self, instruction, *args, **kwargs)
+
+    return wrapper
+
+
+async def _wrap_page(page: Page):
+    """Wrap a Playwright page with AgentQL (prefer async wrapper if available)"""
+    # agentql memoizes the wrapper on the page itself, so repeat calls are cheap
+    try:
+        if hasattr(agentql, "wrap_async"):
+            return await agentql.wrap_async(page)  # type: ignore
+        return agentql.wrap(page)
+    except TypeError:
+        # Fallback to sync wrapper if async signature mismatch
+        return agentql.wrap(page)
+
+
+# Registered as an init script: lists interactive elements inside the viewport
+_SNAPSHOT_JS = """
+window.__uxagent_snapshot = () => {
+    const inViewport = (el) => {
+        const r = el.getBoundingClientRect();
+        return r.width > 0 && r.height > 0 && r.bottom > 0 && r.right > 0
+            && r.top < window.innerHeight && r.left < window.innerWidth;
+    };
+    return [...document.querySelectorAll('a,button,input,select,textarea,[role=button],h1,h2,h3')]
+        .filter(inViewport)
+        .map(e => ({
+            tag: e.tagName.toLowerCase(),
+            text: (e.innerText || e.value || e.getAttribute('aria-label') || '').trim().slice(0, 80),
+            role: e.getAttribute('role'),
+        }));
+};
+"""
+
+# Registered as an init script: timestamps the latest DOM mutation for _await_dom_settled.
+# Attribute changes are ignored: carousels and animations toggle classes/styles
+# continuously and would keep the page from ever looking quiet.
+_MUTATION_JS = """
+if (!window.__uxagent_last_mutation) {
+    window.__uxagent_last_mutation = Date.now();
+    new MutationObserver(() => { window.__uxagent_last_mutation = Date.now(); })
+        .observe(document, {childList: true, subtree: true, characterData: true});
+}
+"""
+
+# The DOM has been quiet for DOM_QUIET_MS and no loading indicator is showing
+_DOM_SETTLED_JS = """
+quietMs => Date.now() - (window.__uxagent_last_mutation || 0) > quietMs
+    && !document.querySelector('.loading, [aria-busy=true]')
+"""
+DOM_QUIET_MS = 150
+# Upper bound on the settle wait; no longer than the fixed sleep it replaced
+DOM_SETTLE_TIMEOUT_MS = 1500
+
+_XPATH_JS = """
+el => {
+    const parts = [];
+    for (; el && el.nodeType === 1; el = el.parentNode) {
+        let i = 1;
+        for (let s = el.previousElementSibling; s; s = s.previousElementSibling) {
+            if (s.tagName === el.tagName) i++;
+        }
+        parts.unshift(el.tagName.toLowerCase() + '[' + i + ']');
+    }
+    return '/' + parts.join('/');
+}
+"""
+
 
 class AgentQLEnv:
     """
@@ -26,11 +232,20 @@ class AgentQLEnv:
     def __init__(self, 
                  headless: bool = True,
                  timeout: int = 30000,
-                 cache_schemas: bool = True):
+                 cache_schemas: bool = True,
+                 block_assets: bool = True,
+                 ws_endpoint: Optional[str] = None):
         self.headless = headless
         self.timeout = timeout
         self.cache_schemas = cache_schemas
-        self.schema_cache = {}  # Your innovation: cache learned schemas
+        # Skip images/fonts/media the agent never looks at; opt out for image-dependent flows
+        self.block_assets = block_assets
+        # Dedicated session to connect to instead of the persisted/env endpoint
+        self.ws_endpoint_override = ws_endpoint
+        # Your innovation: cache learned schemas
+        self.schema_cache = self._load_schema_cache() if cache_schemas else {}
+        # Selector resolved by the last handler, recorded into schema_cache
+        self._resolved: Optional[Dict[str, Any]] = None
         
         # Playwright/AgentQL setup
         self.playwright = None
@@ -42,13 +257,115 @@ class AgentQLEnv:
         # State tracking
         self.current_url = ""
         self.step_count = 0
+        self._last_snapshot: List[Dict[str, Any]] = []
+        # Title/url from the last read; stale once the main frame navigates
+        self._last_state: Dict[str, str] = {}
+        self._nav_dirty = True
         self.max_steps = 50
         
         self.logger = logging.getLogger(__name__)
 
-    def _create_browserbase_session(self, api_key: str, region: str = "us") -> str:
+    @staticmethod
+    def _load_schema_cache() -> Dict[str, Any]:
+        """Load persisted schema cache entries, dropping expired ones"""
+        try:
+            data = json.loads(SCHEMA_CACHE_PATH.read_text())
+        except Exception:
+            return {}
+        now = time.time()
+        cache = {
+            k: v for k, v in data.items()
+            if now - v.get("timestamp", 0) < SCHEMA_CACHE_TTL
+        }
+        # Older entries stored the instruction and fill text in plaintext; scrub the file now
+        if any(f in v for v in cache.values() for f in _SCHEMA_CACHE_PRIVATE_FIELDS):
+            cache = {
+                k: {f: x for f, x in v.items() if f not in _SCHEMA_CACHE_PRIVATE_FIELDS}
+                for k, v in cache.items()
+            }
+            try:
+                _write_schema_cache(cache)
+            except OSError:
+                pass
+        return cache
+
+    def _save_schema_cache(self):
+        """Persist the schema cache atomically so concurrent runs never read a partial file"""
+        try:
+            _write_schema_cache(self.schema_cache)
+        except Exception as e:
+            self.logger.warning(f"Failed to persist schema cache: {e}")
+
+    async def _dom_fingerprint(self) -> str:
+        """Digest of the current DOM with render-specific attributes normalized away"""
+        return await self.agentql_page.evaluate(_DOM_FINGERPRINT_JS)
+
+    async def _replay_cached_action(self, entry: Dict[str, Any], instruction_str: str) -> bool:
+        """Replay a cached selector directly with Playwright; False if it no longer applies"""
+        try:
+            locator = self.page.locator(f"xpath={entry['selector']}").first
+            if entry.get("op") == "fill":
+                # Typed text is never cached; it comes from the instruction being replayed
+                await locator.fill(_parse_fill(instruction_str)[1], timeout=3000)
+            else:
+                await locator.click(timeout=3000)
+            return True
+        except Exception as e:
+            self.logger.info(f"Cached selector replay failed, falling back to AgentQL: {e}")
+            return False
+
+    async def _try_playwright_locators(self, desc: str, kind: str = "click") -> Optional[Locator]:
+        """Resolve desc with cheap deterministic Playwright locators before asking AgentQL.
+
+        Candidates are tried in priority order (button, link, text for clicks; label,
+        placeholder for fills) and one is only used when it matches exactly one
+        visible element by whole name; anything ambiguous is left to AgentQL.
+        A single count on the union first makes a miss cost one CDP call.
+        """
+        desc = desc.strip().strip('"\'')
+        if not desc:
+            return None
+        pattern = re.compile(rf"^\s*{re.escape(desc)}\s*$", re.IGNORECASE)
+        if kind == "fill":
+            candidates = [
+                self.page.get_by_label(pattern),
+                self.page.get_by_placeholder(pattern),
+            ]
+        else:
+            candidates = [
+                self.page.get_by_role("button", name=pattern),
+                self.page.get_by_role("link", name=pattern),
+                self.page.get_by_text(pattern),
+            ]
+        try:
+            union = candidates[0]
+            for loc in candidates[1:]:
+                union = union.or_(loc)
+            if not await union.count():
+                return None
+            for loc in candidates:
+                if await loc.count() == 1 and await loc.is_visible():
+                    return loc
+        except Exception:
+            pass
+        return None
+
+    async def _remember_element(self, element, op: str):
+        """Record the XPath of an element AgentQL resolved, for the schema cache"""
+        if not self.cache_schemas:
+            return
+        try:
+            selector = await element.evaluate(_XPATH_JS)
+        except Exception:
+            return
+        self._resolved = {"selector": selector, "op": op}
+
+    def _create_browserbase_session(self, api_key: str, region: str = "us", persist: bool = True) -> str:
         """Create a Browserbase session and return its Playwright connect URL.
 
+        With persist=False the endpoint is not written to .browserbase_ws_endpoint,
+        so other processes do not pick up a session meant for one caller.
+
         Per docs, prefer 'X-BB-API-Key' header and minimal payload with optional 'projectId'.
         Fallbacks:
           - try lowercase 'x-bb-api-key'
@@ -97,6 +414,8 @@ class AgentQLEnv:
         # Preferred field per docs
         connect_url = data.get("connectUrl")
         if connect_url:
+            if not persist:
+                return connect_url
             # Persist WS endpoint for reuse across processes
             try:
                 (Path(__file__).resolve().parents[3] / ".browserbase_ws_endpoint").write_text(connect_url)
@@ -106,6 +425,8 @@ class AgentQLEnv:
         # Backward/alt compatibility
         ws_url = data.get("wsUrl")
         if ws_url:
+            if not persist:
+                return ws_url
             try:
                 (Path(__file__).resolve().parents[3] / ".browserbase_ws_endpoint").write_text(ws_url)
             except Exception:
@@ -120,11 +441,12 @@ class AgentQLEnv:
             
             # Connect to Browserbase via CDP. Local browser fallback is removed.
             using_remote_cdp = False
-            # Try persisted endpoint first, then env
+            # Explicit endpoint first, then persisted endpoint, then env
+            dedicated = bool(self.ws_endpoint_override)
             persisted_path = Path(__file__).resolve().parents[3] / ".browserbase_ws_endpoint"
-            ws_endpoint = None
+            ws_endpoint = self.ws_endpoint_override
             try:
-                if persisted_path.exists():
+                if not ws_endpoint and persisted_path.exists():
                     ws_endpoint = persisted_path.read_text().strip()
             except Exception:
                 pass
@@ -162,8 +484,9 @@ class AgentQLEnv:
                     if api_key:
                         try:
                             self.logger.info("Attempting to create a fresh Browserbase session via API...")
-                            ws_endpoint = self._create_browserbase_session(api_key)
-                            os.environ["BROWSERBASE_WS_ENDPOINT"] = ws_endpoint
+                            ws_endpoint = self._create_browserbase_session(api_key, persist=not dedicated)
+                            if not dedicated:
+                                os.environ["BROWSERBASE_WS_ENDPOINT"] = ws_endpoint
                             self.browser = await self.playwright.chromium.connect_over_cdp(ws_endpoint)
                             using_remote_cdp = True
                             self.logger.info("Connected to remote browser via CDP (Browserbase) on retry")
@@ -196,24 +519,15 @@ class AgentQLEnv:
                 )
 
             # Block ad/analytics heavy third-party requests to speed up page readiness
-            blocked_domains = [
-                'googlesyndication.com',
-                'doubleclick.net',
-                'g.doubleclick.net',
-                'google-analytics.com',
-                'googletagmanager.com',
-                'facebook.net',
-                'google.com/recaptcha',
-                'safeframe.googlesyndication.com',
-                'adservice.google.com',
-            ]
+            block_assets = self.block_assets
 
             async def route_handler(route):
                 try:
                     req = route.request
-                    url = req.url
-                    host = urlparse(url).hostname or ""
-                    if any(domain in url or domain in host for domain in blocked_domains):
+                    if block_assets and req.resource_type in _BLOCKED_RESOURCE_TYPES:
+                        await route.abort()
+                        return
+                    if _BLOCKED_URL_RE.search(req.url):
                         await route.abort()
                     else:
                         await route.continue_()
@@ -225,10 +539,19 @@ class AgentQLEnv:
 
             try:
                 await self.context.route("**/*", route_handler)
-                self.logger.info("Enabled network routing to block ad/analytics domains")
+                self.logger.info(
+                    "Enabled network routing to block ad/analytics domains%s",
+                    " and image/font/media assets" if block_assets else ""
+                )
             except Exception as e:
                 self.logger.warning(f"Failed to enable network routing: {e}")
             
+            try:
+                await self.context.add_init_script(script=_SNAPSHOT_JS)
+                await self.context.add_init_script(script=_MUTATION_JS)
+            except Exception as e:
+                self.logger.warning(f"Failed to register init scripts: {e}")
+            
             # Create or reuse a visible page and bring to front (helps live viewers)
             if self.context.pages:
                 self.page = self.context.pages[0]
@@ -250,15 +573,12 @@ class AgentQLEnv:
             except Exception:
                 pass
 
-            # Wrap with AgentQL for AI-powered automation (prefer async wrapper if available)
-            try:
-                if hasattr(agentql, "wrap_async"):
-                    self.agentql_page = await agentql.wrap_async(self.page)  # type: ignore
-                else:
-                    self.agentql_page = agentql.wrap(self.page)
-            except TypeError:
-                # Fallback to sync wrapper if async signature mismatch
-                self.agentql_page = agentql.wrap(self.page)
+            # Wrap with AgentQL for AI-powered automation
+            self.agentql_page = await _wrap_page(self.page)
+
+            # Fires for full loads and same-document (history API) navigations alike
+            self._nav_dirty = True
+            self.page.on("framenavigated", self._on_frame_navigated)
             
             self.logger.info("AgentQL environment initialized successfully")
             
@@ -266,8 +586,12 @@ class AgentQLEnv:
             self.logger.error(f"Failed to setup AgentQL environment: {e}")
             raise
     
-    async def navigate_to(self, url: str) -> Dict[str, Any]:
-        """Navigate to a URL and prepare for automation"""
+    async def navigate_to(self, url: str, wait_until: str = 'domcontentloaded') -> Dict[str, Any]:
+        """Navigate to a URL and prepare for automation.
+
+        wait_until is passed to goto(); pass 'load' or 'networkidle' only for
+        pages that need it, since long-polling sites rarely reach networkidle.
+        """
         try:
             self.current_url = url
             self.step_count = 0
@@ -283,7 +607,7 @@ class AgentQLEnv:
             await self.agentql_page.goto(
                 url,
                 timeout=self.timeout * 2,
-                wait_until='domcontentloaded'
+                wait_until=wait_until
             )
 
             # Soft-wait for additional network settling without hard failing
@@ -292,14 +616,9 @@ class AgentQLEnv:
             except Exception:
                 # Ignore if 'load' doesn't occur quickly; proceed with DOM ready
                 pass
-            try:
-                # Some sites keep long polling; keep this short and best-effort
-                await self.agentql_page.wait_for_load_state('networkidle', timeout=3000)
-            except Exception:
-                pass
             
-            # Fix viewport and zoom issues after page loads
-            await self.agentql_page.evaluate("""
+            # Fix viewport and zoom issues after page loads, reading page info in the same call
+            state = await self.agentql_page.evaluate("""
                 () => {
                     // Reset any zoom or scale transforms
                     document.body.style.zoom = '1';
@@ -309,12 +628,15 @@ class AgentQLEnv:
                     
                     // Scroll to top-left to ensure proper positioning
                     window.scrollTo(0, 0);
+                    return {title: document.title, url: location.href};
                 }
             """)
             
             # Get page info
-            title = await self.agentql_page.title()
-            current_url = self.agentql_page.url
+            title = state["title"]
+            current_url = state["url"]
+            self._last_state = state
+            self._nav_dirty = False
             
             self.logger.info(f"Successfully loaded: {title}")
             
@@ -333,10 +655,27 @@ class AgentQLEnv:
                 "step": self.step_count
             }
     
-    async def execute_action(self, natural_language_instruction: str) -> Dict[str, Any]:
+    def _on_frame_navigated(self, frame):
+        if frame.parent_frame is None:
+            self._nav_dirty = True
+
+    async def _page_state(self) -> Dict[str, str]:
+        """Read title and URL in a single round-trip, skipped when the page has not navigated"""
+        if self._nav_dirty or not self._last_state:
+            # Clear the flag first so a navigation during the read marks it dirty again
+            self._nav_dirty = False
+            self._last_state = await self.agentql_page.evaluate(
+                "() => ({title: document.title, url: location.href})"
+            )
+        return dict(self._last_state)
+
+    @_ensure_str_instruction
+    async def execute_action(self, natural_language_instruction: str, collect_state: bool = True) -> Dict[str, Any]:
         """
         Execute an action using natural language instruction.
         This is where AgentQL shines - no need for manual CSS selectors!
+
+        Pass collect_state=False to skip reading the resulting title/url.
         """
         try:
             self.step_count += 1
@@ -348,57 +687,48 @@ class AgentQLEnv:
                     "step": self.step_count
                 }
             
-            # Validate input parameter
-            if isinstance(natural_language_instruction, dict):
-                if 'instruction' in natural_language_instruction:
-                    instruction_str = str(natural_language_instruction['instruction'])
-                elif 'action' in natural_language_instruction:
-                    instruction_str = str(natural_language_instruction['action'])
-                else:
-                    instruction_str = str(natural_language_instruction)
-                self.logger.warning(f"Received dictionary instead of string, converted: {instruction_str}")
-            elif not isinstance(natural_language_instruction, str):
-                instruction_str = str(natural_language_instruction)
-                self.logger.warning(f"Received {type(natural_language_instruction)} instead of string, converted: {instruction_str}")
-            else:
-                instruction_str = natural_language_instruction
-            
+            instruction_str = natural_language_instruction
             self.logger.info(f"Step {self.step_count}: {instruction_str}")
             
-            # Check if we have cached schema for this type of action
-            cache_key = f"{self.current_url}:{instruction_str}"
-            
-            if self.cache_schemas and cache_key in self.schema_cache:
+            # Check if we have cached schema for this action on an identical DOM
+            cache_key = None
+            replayed = False
+            self._resolved = None
+            if self.cache_schemas:
+                try:
+                    dom_digest = await self._dom_fingerprint()
+                    cache_key = hashlib.sha256(
+                        f"{self.agentql_page.url}|{instruction_str}|{dom_digest}".encode("utf-8")
+                    ).hexdigest()
+                except Exception as e:
+                    self.logger.warning(f"Failed to fingerprint DOM: {e}")
+            cached = self.schema_cache.get(cache_key) if cache_key else None
+            if cached and cached.get("selector"):
                 self.logger.info("Using cached schema for faster execution")
-                # Future enhancement: use cached schema for faster execution
-            
-            # More intelligent action parsing
-            instruction_lower = instruction_str.lower()
+                replayed = await self._replay_cached_action(cached, instruction_str)
+                if not replayed:
+                    self.schema_cache.pop(cache_key, None)
             
             try:
                 # Use AgentQL to execute the action based on content analysis
-                # Handle keyboard submit before generic "press" keywords
-                if "press enter" in instruction_lower or "submit search" in instruction_lower or instruction_lower == "submit":
-                    await self._handle_navigation_action(instruction_str)
-                elif any(keyword in instruction_lower for keyword in ["click", "tap", "press", "select", "choose"]):
-                    # Handle click-like actions
-                    await self._handle_click_action(instruction_str)
-                elif any(keyword in instruction_lower for keyword in ["fill", "type", "enter", "input", "write"]):
-                    # Handle input actions
-                    await self._handle_input_action(instruction_str)
-                elif any(keyword in instruction_lower for keyword in ["select", "dropdown", "choose option"]):
-                    # Handle select actions
-                    await self._handle_select_action(instruction_str)
-                elif any(keyword in instruction_lower for keyword in ["scroll", "navigate", "go to"]):
-                    # Handle navigation actions
-                    await self._handle_navigation_action(instruction_str)
+                if replayed:
+                    # Cached selector already performed the action
+                    pass
                 else:
-                    # Generic action handling
-                    self.logger.info(f"Using generic action handler for: {instruction_str}")
-                    await self._handle_generic_action(instruction_str)
+                    route = _route_instruction(instruction_str)
+                    if route is None:
+                        self.logger.info(f"Using generic action handler for: {instruction_str}")
+                    handler = {
+                        "submit": self._handle_navigation_action,
+                        "input": self._handle_input_action,
+                        "select": self._handle_select_action,
+                        "nav": self._handle_navigation_action,
+                        "click": self._handle_click_action,
+                    }.get(route, self._handle_generic_action)
+                    await handler(instruction_str)
                 
                 # Wait for any navigation or dynamic content
-                await self.agentql_page.wait_for_timeout(1500)
+                await self._await_dom_settled()
                 
             except Exception as action_error:
                 self.logger.error(f"Action execution failed: {action_error}")
@@ -406,28 +736,27 @@ class AgentQLEnv:
                 try:
                     self.logger.info("Attempting fallback with generic action handler")
                     await self._handle_generic_action(instruction_str)
-                    await self.agentql_page.wait_for_timeout(1000)
+                    await self._await_dom_settled()
                 except Exception as fallback_error:
                     self.logger.error(f"Fallback action also failed: {fallback_error}")
                     raise action_error  # Raise the original error
             
             # Get current state
-            title = await self.agentql_page.title()
-            current_url = self.agentql_page.url
+            state = await self._page_state() if collect_state else {}
             
-            # Cache successful actions for future optimization
-            if self.cache_schemas:
+            # Cache the resolved selector so the next run on this DOM skips AgentQL
+            if cache_key and self._resolved and not replayed:
                 self.schema_cache[cache_key] = {
-                    "action": instruction_str,
+                    **self._resolved,
                     "success": True,
                     "timestamp": time.time()
                 }
+                self._save_schema_cache()
             
             return {
                 "success": True,
                 "action": instruction_str,
-                "title": title,
-                "url": current_url,
+                **state,
                 "step": self.step_count
             }
             
@@ -440,6 +769,21 @@ class AgentQLEnv:
                 "step": self.step_count
             }
     
+    async def _await_dom_settled(self):
+        """Return as soon as the DOM stops mutating after an action instead of sleeping"""
+        try:
+            await self.agentql_page.wait_for_load_state('domcontentloaded', timeout=self.timeout)
+        except Exception:
+            pass
+        try:
+            # Pages loaded before the init script was registered have no observer and
+            # only wait on loading indicators
+            await self.agentql_page.wait_for_function(
+                _DOM_SETTLED_JS, arg=DOM_QUIET_MS, timeout=DOM_SETTLE_TIMEOUT_MS, polling=50
+            )
+        except Exception:
+            pass
+    
     async def extract_data(self, query) -> Dict[str, Any]:
         """
         Extract structured data using AgentQL's natural language queries.
@@ -451,19 +795,10 @@ class AgentQLEnv:
             # Convert string query to proper AgentQL format
             if isinstance(query, str):
                 # Clean the query description for AgentQL format
-                import re
-                clean_query = query.lower().replace(" ", "_").replace("-", "_")
-                clean_query = re.sub(r'[^a-zA-Z0-9_]', '', clean_query)
-                
-                if not clean_query:
-                    clean_query = "page_data"
+                clean_query = _agentql_slug(query) or "page_data"
                 
                 # Use correct AgentQL syntax for data extraction
-                agentql_query = f"""
-                {{
-                    {clean_query}
-                }}
-                """
+                agentql_query = _wrap_query(clean_query)
             else:
                 # Assume it's already in correct format
                 agentql_query = query
@@ -491,28 +826,9 @@ class AgentQLEnv:
                 "step": self.step_count
             }
     
-    async def _handle_click_action(self, instruction):
+    @_ensure_str_instruction
+    async def _handle_click_action(self, instruction_str: str):
         """Handle clicking actions with AgentQL"""
-        # Validate and convert instruction parameter
-        if isinstance(instruction, dict):
-            # If instruction is a dict, try to extract meaningful information
-            if 'instruction' in instruction:
-                instruction_str = str(instruction['instruction'])
-            elif 'text' in instruction:
-                instruction_str = str(instruction['text'])
-            elif 'action' in instruction:
-                instruction_str = str(instruction['action'])
-            else:
-                # Convert dict to string representation
-                instruction_str = str(instruction)
-            self.logger.warning(f"Received dictionary instead of string for instruction, converted: {instruction_str}")
-        elif not isinstance(instruction, str):
-            # Convert any other type to string
-            instruction_str = str(instruction)
-            self.logger.warning(f"Received {type(instruction)} instead of string for instruction, converted: {instruction_str}")
-        else:
-            instruction_str = instruction
-        
         self.logger.info(f"Processing click action: {instruction_str}")
         
         # Extract what to click from the instruction
@@ -527,26 +843,21 @@ class AgentQLEnv:
         
         self.logger.info(f"Looking for element: {element_description}")
         
-        # Use AgentQL to find and click the element using correct syntax
-        self.logger.info(f"Looking for element: {element_description}")
+        # Fast path: plain Playwright locators, no AgentQL round-trip
+        locator = await self._try_playwright_locators(_ACTION_VERB_RE.sub("", instruction_str))
+        if locator is not None:
+            await self._remember_element(locator, "click")
+            await locator.click(timeout=self.timeout)
+            self.logger.info(f"Clicked element via Playwright locator: {element_description}")
+            return
         
+        # Use AgentQL to find and click the element using correct syntax
         try:
             # Convert element description to AgentQL format
-            # Clean the description to make it suitable for AgentQL
-            clean_description = element_description.lower().replace(" ", "_").replace("-", "_")
-            # Remove any non-alphanumeric characters except underscores
-            import re
-            clean_description = re.sub(r'[^a-zA-Z0-9_]', '', clean_description)
-            
-            if not clean_description:
-                clean_description = "clickable_element"
+            clean_description = _agentql_slug(element_description) or "clickable_element"
             
             # Use AgentQL's correct syntax format
-            query = f"""
-            {{
-                {clean_description}
-            }}
-            """
+            query = _wrap_query(clean_description)
             
             self.logger.info(f"AgentQL query: {query}")
             elements = await self.agentql_page.query_elements(query)
@@ -568,6 +879,8 @@ class AgentQLEnv:
                             await target_element.scroll_into_view_if_needed()
                         except Exception:
                             pass
+                        # Resolve the XPath before clicking; the click may navigate away
+                        await self._remember_element(target_element, "click")
                         await target_element.click()
                         self.logger.info(f"Successfully clicked element: {element_description}")
                         click_error = None
@@ -603,11 +916,7 @@ class AgentQLEnv:
                 # Try alternative approach with generic button/link query
                 try:
                     # Alternative: query for common clickable elements
-                    alt_query = """
-                    {{
-                        clickable_btn
-                    }}
-                    """
+                    alt_query = _wrap_query("clickable_btn")
                     alt_elements = await self.agentql_page.query_elements(alt_query)
                     if alt_elements and hasattr(alt_elements, 'clickable_btn') and alt_elements.clickable_btn:
                         await alt_elements.clickable_btn.click()
@@ -627,46 +936,30 @@ class AgentQLEnv:
             self.logger.error(f"Click action failed for '{element_description}': {e}")
             raise
 
-    async def _handle_input_action(self, instruction):
+    @_ensure_str_instruction
+    async def _handle_input_action(self, instruction_str: str):
         """Handle input/typing actions with AgentQL"""
-        # Validate and convert instruction parameter  
-        if isinstance(instruction, dict):
-            if 'instruction' in instruction:
-                instruction_str = str(instruction['instruction'])
-            elif 'text' in instruction:
-                instruction_str = str(instruction['text'])
-            else:
-                instruction_str = str(instruction)
-            self.logger.warning(f"Received dictionary instead of string for instruction, converted: {instruction_str}")
-        elif not isinstance(instruction, str):
-            instruction_str = str(instruction)
-            self.logger.warning(f"Received {type(instruction)} instead of string for instruction, converted: {instruction_str}")
-        else:
-            instruction_str = instruction
-            
         self.logger.info(f"Processing input action: {instruction_str}")
         
         # Parse the instruction to extract field and value
         if "fill" in instruction_str:
-            parts = instruction_str.split("with")
-            field_desc = parts[0].replace("fill", "").strip()
-            value = parts[1].strip() if len(parts) > 1 else ""
-            # Strip wrapping quotes if present
-            if (value.startswith('"') and value.endswith('"')) or (value.startswith("'") and value.endswith("'")):
-                value = value[1:-1]
-            
-            # Clean up the description
-            field_desc = field_desc.replace('"', '').replace("'", "").replace(":", "")
+            field_desc, value = _parse_fill(instruction_str)
             
             if not field_desc:
                 raise Exception("No field description found in fill instruction")
                 
             self.logger.info(f"Looking for input field: {field_desc}, value: {value}")
             
+            # Fast path: label/placeholder locators, no AgentQL round-trip
+            locator = await self._try_playwright_locators(field_desc, kind="fill")
+            if locator is not None:
+                await self._remember_element(locator, "fill")
+                await locator.fill(value)
+                self.logger.info(f"Filled field '{field_desc}' via Playwright locator")
+                return
+            
             # Clean the field description for AgentQL format
-            import re
-            clean_field_desc = field_desc.lower().replace(" ", "_").replace("-", "_")
-            clean_field_desc = re.sub(r'[^a-zA-Z0-9_]', '', clean_field_desc)
+            clean_field_desc = _agentql_slug(field_desc)
             
             if not clean_field_desc:
                 clean_field_desc = "input_field"
@@ -674,11 +967,7 @@ class AgentQLEnv:
                 clean_field_desc += "_field"
             
             # Use correct AgentQL syntax
-            query = f"""
-            {{
-                {clean_field_desc}
-            }}
-            """
+            query = _wrap_query(clean_field_desc)
             
             try:
                 self.logger.info(f"AgentQL input query: {query}")
@@ -686,17 +975,14 @@ class AgentQLEnv:
                 if elements and hasattr(elements, clean_field_desc):
                     input_element = getattr(elements, clean_field_desc)
                     if input_element:
+                        await self._remember_element(input_element, "fill")
                         await input_element.fill(value)
                         self.logger.info(f"Successfully filled field '{field_desc}' with '{value}'")
                     else:
                         raise Exception(f"Input element {clean_field_desc} was None")
                 else:
                     # Try alternative query with generic input
-                    alt_query = """
-                    {
-                        input_box
-                    }
-                    """
+                    alt_query = _wrap_query("input_box")
                     alt_elements = await self.agentql_page.query_elements(alt_query)
                     if alt_elements and hasattr(alt_elements, 'input_box') and alt_elements.input_box:
                         await alt_elements.input_box.fill(value)
@@ -715,62 +1001,26 @@ class AgentQLEnv:
         else:
             raise Exception(f"Unsupported input instruction format: {instruction_str}")
 
-    async def _handle_select_action(self, instruction):
+    @_ensure_str_instruction
+    async def _handle_select_action(self, instruction_str: str):
         """Handle select dropdown actions with AgentQL"""
-        # Validate and convert instruction parameter
-        if isinstance(instruction, dict):
-            if 'instruction' in instruction:
-                instruction_str = str(instruction['instruction'])
-            else:
-                instruction_str = str(instruction)
-            self.logger.warning(f"Received dictionary instead of string for instruction, converted: {instruction_str}")
-        elif not isinstance(instruction, str):
-            instruction_str = str(instruction)
-            self.logger.warning(f"Received {type(instruction)} instead of string for instruction, converted: {instruction_str}")
-        else:
-            instruction_str = instruction
-            
         self.logger.info(f"Processing select action: {instruction_str}")
         
         # TODO: Implement select dropdown handling
         # For now, treat as a click action
         await self._handle_click_action(instruction_str)
 
-    async def _handle_generic_action(self, instruction):
+    @_ensure_str_instruction
+    async def _handle_generic_action(self, instruction_str: str):
         """Handle any other action types"""
-        # Validate and convert instruction parameter
-        if isinstance(instruction, dict):
-            if 'instruction' in instruction:
-                instruction_str = str(instruction['instruction'])
-            else:
-                instruction_str = str(instruction)
-            self.logger.warning(f"Received dictionary instead of string for instruction, converted: {instruction_str}")
-        elif not isinstance(instruction, str):
-            instruction_str = str(instruction)
-            self.logger.warning(f"Received {type(instruction)} instead of string for instruction, converted: {instruction_str}")
-        else:
-            instruction_str = instruction
-            
         self.logger.info(f"Processing generic action: {instruction_str}")
         
         # For now, try to parse as a click action
         await self._handle_click_action(instruction_str)
     
-    async def _handle_navigation_action(self, instruction):
+    @_ensure_str_instruction
+    async def _handle_navigation_action(self, instruction_str: str):
         """Handle navigation actions like scroll, go to URL, etc."""
-        # Validate and convert instruction parameter
-        if isinstance(instruction, dict):
-            if 'instruction' in instruction:
-                instruction_str = str(instruction['instruction'])
-            else:
-                instruction_str = str(instruction)
-            self.logger.warning(f"Received dictionary instead of string for instruction, converted: {instruction_str}")
-        elif not isinstance(instruction, str):
-            instruction_str = str(instruction)
-            self.logger.warning(f"Received {type(instruction)} instead of string for instruction, converted: {instruction_str}")
-        else:
-            instruction_str = instruction
-            
         self.logger.info(f"Processing navigation action: {instruction_str}")
         
         instruction_lower = instruction_str.lower()
@@ -803,25 +1053,39 @@ class AgentQLEnv:
             # Default to click action
             await self._handle_click_action(instruction_str)
     
-    async def get_page_info(self) -> Dict[str, Any]:
-        """Get current page information"""
+    async def _snapshot(self) -> List[Dict[str, Any]]:
+        """Interactive elements currently in the viewport, via the injected helper"""
+        snapshot = await self.page.evaluate(
+            "() => window.__uxagent_snapshot ? window.__uxagent_snapshot() : null"
+        )
+        if snapshot is None:
+            # Page was loaded before the init script was registered (e.g. a reused context)
+            await self.page.evaluate(_SNAPSHOT_JS)
+            snapshot = await self.page.evaluate("() => window.__uxagent_snapshot()")
+        return snapshot
+
+    async def get_page_info(self, diff_only: bool = False) -> Dict[str, Any]:
+        """Get current page information.
+
+        elements lists interactive elements in the viewport. With diff_only, only the
+        elements added/removed since the previous call are returned.
+        """
         try:
-            title = await self.agentql_page.title()
-            url = self.agentql_page.url
-            
-            # Extract key page elements using AgentQL
-            page_elements_query = {
-                "headings": "all headings on the page",
-                "buttons": "all clickable buttons", 
-                "links": "all navigation links",
-                "forms": "all input forms"
-            }
+            state, snapshot = await asyncio.gather(self._page_state(), self._snapshot())
             
-            elements = await self.agentql_page.query_data(page_elements_query)
+            if diff_only:
+                previous = {json.dumps(e, sort_keys=True) for e in self._last_snapshot}
+                current = {json.dumps(e, sort_keys=True) for e in snapshot}
+                elements = {
+                    "added": [e for e in snapshot if json.dumps(e, sort_keys=True) not in previous],
+                    "removed": [e for e in self._last_snapshot if json.dumps(e, sort_keys=True) not in current],
+                }
+            else:
+                elements = snapshot
+            self._last_snapshot = snapshot
             
             return {
-                "title": title,
-                "url": url,
+                **state,
                 "elements": elements,
                 "step": self.step_count
             }
@@ -854,9 +1118,75 @@ class AgentQLUniversalAgent:
     This is your competitive advantage!
     """
     
-    def __init__(self, headless: bool = True):
-        self.env = AgentQLEnv(headless=headless)
+    def __init__(self, headless: bool = True, ws_endpoint: Optional[str] = None):
+        self.env = AgentQLEnv(headless=headless, ws_endpoint=ws_endpoint)
+        # True while used as `async with`: the browser session outlives each persona run
+        self._persistent = False
         self.logger = logging.getLogger(__name__)
+
+    async def __aenter__(self):
+        """Set up the browser once and reuse it for every run_persona_task call"""
+        await self.env.setup()
+        self._persistent = True
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, tb):
+        self._persistent = False
+        await self.env.cleanup()
+
+    async def _iter_steps(self, steps: List[str]) -> AsyncIterator[Dict[str, Any]]:
+        """Run steps in order, yielding each result as soon as it completes"""
+        for step in steps:
+            result = await self.env.execute_action(step)
+            if not result["success"]:
+                self.logger.warning(f"Step failed: {step}")
+                # Continue with other steps
+            yield result
+
+    @contextlib.asynccontextmanager
+    async def _task_session(self):
+        """Browser session for one persona run; a no-op setup/teardown under `async with`"""
+        try:
+            if not self._persistent:
+                await self.env.setup()
+            yield
+        finally:
+            if not self._persistent:
+                await self.env.cleanup()
+
+    async def _start_task(self, persona: Dict[str, Any], target_url: str):
+        """Navigate to target_url and plan the steps; steps is empty if navigation failed"""
+        nav_result = await self.env.navigate_to(target_url)
+        if not nav_result["success"]:
+            return nav_result, []
+        
+        # Extract persona goal and preferences
+        goal = persona.get("goal", "Browse and interact with the website")
+        preferences = persona.get("preferences", {})
+        
+        self.logger.info(f"Running persona task: {goal}")
+        
+        # Convert goal into actionable steps using AgentQL
+        steps = await self._generate_action_steps(goal, preferences, target_url)
+        return nav_result, steps
+
+    async def iter_persona_task(
+        self, persona: Dict[str, Any], target_url: str, stop_on_failure: bool = False
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Like run_persona_task, but yields each step result as soon as it completes.
+        A failed navigation is yielded as the only result. With stop_on_failure the
+        run ends after the first failed step.
+        """
+        async with self._task_session():
+            nav_result, steps = await self._start_task(persona, target_url)
+            if not nav_result["success"]:
+                yield nav_result
+                return
+            async for result in self._iter_steps(steps):
+                yield result
+                if stop_on_failure and not result["success"]:
+                    return
     
     async def run_persona_task(self, persona: Dict[str, Any], target_url: str) -> Dict[str, Any]:
         """
@@ -864,42 +1194,24 @@ class AgentQLUniversalAgent:
         This replaces your manual recipe approach with universal automation.
         """
         try:
-            await self.env.setup()
-            
-            # Navigate to target website
-            nav_result = await self.env.navigate_to(target_url)
-            if not nav_result["success"]:
-                return nav_result
-            
-            # Extract persona goal and preferences
-            goal = persona.get("goal", "Browse and interact with the website")
-            preferences = persona.get("preferences", {})
-            
-            self.logger.info(f"Running persona task: {goal}")
-            
-            # Convert goal into actionable steps using AgentQL
-            steps = await self._generate_action_steps(goal, preferences, target_url)
-            
-            results = []
-            for step in steps:
-                result = await self.env.execute_action(step)
-                results.append(result)
+            async with self._task_session():
+                nav_result, steps = await self._start_task(persona, target_url)
+                if not nav_result["success"]:
+                    return nav_result
                 
-                if not result["success"]:
-                    self.logger.warning(f"Step failed: {step}")
-                    # Continue with other steps
-            
-            # Extract final results
-            final_data = await self.env.extract_data("summary of actions taken and current page state")
-            
-            return {
-                "success": True,
-                "persona": persona,
-                "url": target_url,
-                "steps_executed": results,
-                "final_data": final_data,
-                "total_steps": len(steps)
-            }
+                results = [result async for result in self._iter_steps(steps)]
+                
+                # Extract final results
+                final_data = await self.env.extract_data("summary of actions taken and current page state")
+                
+                return {
+                    "success": True,
+                    "persona": persona,
+                    "url": target_url,
+                    "steps_executed": results,
+                    "final_data": final_data,
+                    "total_steps": len(steps)
+                }
             
         except Exception as e:
             self.logger.error(f"Persona task failed: {e}")
@@ -909,8 +1221,6 @@ class AgentQLUniversalAgent:
                 "persona": persona,
                 "url": target_url
             }
-        finally:
-            await self.env.cleanup()
     
     async def _generate_action_steps(self, goal: str, preferences: Dict[str, Any], target_url: str) -> List[str]:
         """
@@ -948,4 +1258,40 @@ class AgentQLUniversalAgent:
             "click featured items",
         ]
     
-    # Removed site/category-specific helpers for true universality
\ No newline at end of file
+    # Removed site/category-specific helpers for true universality
+
+async def run_persona_batch(
+    tasks: List[Dict[str, Any]], workers: int = 4, headless: bool = True
+) -> List[Dict[str, Any]]:
+    """
+    Run many {"persona": ..., "target_url": ...} tasks over a fixed set of workers.
+    Each worker creates its own Browserbase session and holds it for its lifetime,
+    only getting a fresh navigation per task. Results come back in the order of tasks.
+    Requires BROWSERBASE_API_KEY: the shared persisted/env endpoint would put every
+    worker on the same remote page.
+    """
+    if not tasks:
+        return []
+    api_key = os.getenv("BROWSERBASE_API_KEY")
+    if not api_key:
+        raise RuntimeError("run_persona_batch needs BROWSERBASE_API_KEY to create one session per worker")
+    session_factory = AgentQLEnv(cache_schemas=False)
+    queue: asyncio.Queue = asyncio.Queue()
+    for i, task in enumerate(tasks):
+        queue.put_nowait((i, task))
+    results: List[Optional[Dict[str, Any]]] = [None] * len(tasks)
+
+    async def worker():
+        ws_endpoint = await asyncio.to_thread(
+            session_factory._create_browserbase_session, api_key, persist=False
+        )
+        async with AgentQLUniversalAgent(headless=headless, ws_endpoint=ws_endpoint) as agent:
+            while True:
+                try:
+                    i, task = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                results[i] = await agent.run_persona_task(task["persona"], task["target_url"])
+
+    await asyncio.gather(*[worker() for _ in range(max(1, min(workers, len(tasks))))])
+    return results
@@ -3,7 +3,6 @@ import logging
 import os
 import re
 from typing import Any, Dict, Optional
-from urllib.parse import urlparse
 
 import requests
 from playwright.async_api import (
@@ -16,11 +15,19 @@ from playwright.async_api import (
 from ..agent import gpt
 from pathlib import Path
 from dotenv import load_dotenv
-from .dom_agentql_env import AgentQLEnv
+from .dom_agentql_env import AgentQLEnv, _BLOCKED_URL_RE
 
 
 logger = logging.getLogger(__name__)
 
+# Patterns used on every think/act step, compiled once
+_JSON_OBJECT_RE = re.compile(r"\{[\s\S]*\}")
+_ADD_TO_CART_RE = re.compile(r"add to cart", re.IGNORECASE)
+_ADD_TO_CART_OR_BAG_RE = re.compile(r"add to (cart|bag)", re.IGNORECASE)
+_ADDED_TO_CART_RE = re.compile(r"added to cart|in your cart", re.IGNORECASE)
+_VIEW_CART_RE = re.compile(r"view cart\s*&\s*checkout", re.IGNORECASE)
+_VIEW_CART_EXACT_RE = re.compile(r"^\s*view cart\s*&\s*checkout\s*$", re.IGNORECASE)
+
 
 class BrowserbaseConnector:
     def __init__(self, timeout: int = 30000, ws_endpoint: Optional[str] = None):
@@ -123,24 +130,10 @@ class BrowserbaseConnector:
                 },
             )
 
-        blocked_domains = [
-            "googlesyndication.com",
-            "doubleclick.net",
-            "g.doubleclick.net",
-            "google-analytics.com",
-            "googletagmanager.com",
-            "facebook.net",
-            "google.com/recaptcha",
-            "safeframe.googlesyndication.com",
-            "adservice.google.com",
-        ]
-
         async def route_handler(route):
             try:
                 req = route.request
-                url = req.url
-                host = urlparse(url).hostname or ""
-                if any(domain in url or domain in host for domain in blocked_domains):
+                if _BLOCKED_URL_RE.search(req.url):
                     await route.abort()
                 else:
                     await route.continue_()
@@ -255,8 +248,7 @@ class ComputerUseEnv:
         try:
             action = json.loads(resp)
         except Exception:
-            import re
-            js = re.findall(r"\{[\\s\\S]*\}", resp)
+            js = _JSON_OBJECT_RE.findall(resp)
             action = json.loads(js[0]) if js else {"action": "scroll", "target": "down"}
         return action
 
@@ -335,9 +327,9 @@ class ComputerUseEnv:
             # Prefer explicit product add-to-cart buttons
             candidates = [
                 page.locator('button[data-test="addToCartButton" i]'),
-                page.get_by_role("button", name=re.compile(r"add to (cart|bag)", re.IGNORECASE)),
+                page.get_by_role("button", name=_ADD_TO_CART_OR_BAG_RE),
                 page.locator('button[aria-label*="Add to cart" i]'),
-                page.locator("button", has_text=re.compile(r"add to (cart|bag)", re.IGNORECASE)),
+                page.locator("button", has_text=_ADD_TO_CART_OR_BAG_RE),
             ]
             for loc in candidates:
                 try:
@@ -389,9 +381,9 @@ class ComputerUseEnv:
         async def goto_cart_if_visible() -> bool:
             # Only follow explicit confirmation affordances
             options = [
-                page.get_by_role("button", name=re.compile(r"view cart\s*&\s*checkout", re.IGNORECASE)),
-                page.get_by_role("link", name=re.compile(r"view cart\s*&\s*checkout", re.IGNORECASE)),
-                page.get_by_text(re.compile(r"^\s*view cart\s*&\s*checkout\s*$", re.IGNORECASE)),
+                page.get_by_role("button", name=_VIEW_CART_RE),
+                page.get_by_role("link", name=_VIEW_CART_RE),
+                page.get_by_text(_VIEW_CART_EXACT_RE),
             ]
             for loc in options:
                 try:
@@ -447,7 +439,7 @@ class ComputerUseEnv:
                     pass
             elif a == "click":
                 # Special handling: if the target looks like an Add to Cart request, try generic add-to-cart flows
-                if re.search(r"add to cart", target, re.IGNORECASE):
+                if _ADD_TO_CART_RE.search(target):
                     # Pre-select variants if required
                     try:
                         await try_select_variants()
@@ -458,7 +450,7 @@ class ComputerUseEnv:
                         try:
                             await page.wait_for_timeout(1200)
                             # If a confirmation text appears, prefer explicit checkout affordance
-                            confirm = page.get_by_text(re.compile(r"added to cart|in your cart", re.IGNORECASE))
+                            confirm = page.get_by_text(_ADDED_TO_CART_RE)
                             if await confirm.count():
                                 await goto_cart_if_visible()
                             else:
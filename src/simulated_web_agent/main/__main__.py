@@ -13,7 +13,7 @@ from ..agent import gpt
 from ..executor.dom_agentql_env import AgentQLUniversalAgent
 from ..executor.dom_llm_actions_env import ComputerUseEnv
 from ..executor.openai_computer_use import OpenAIComputerUseRunner
-from ..executor.anthropic_computer_use import AnthropicComputerUseRunner
+from ..executor.anthropic_computer_use import AnthropicComputerUseRunner, close_browserbase_pool
 
 from .model import AgentPolicy, HumanPolicy, OpenAIPolicy  # noqa  # noqa
 
@@ -183,13 +183,17 @@ async def main(
             # Native Anthropic Computer Use (does not use Browserbase)
             runner = AnthropicComputerUseRunner()
             # Prefer full loop with Browserbase executor
-            result = await runner.run_browserbase(
-                persona=persona_data,
-                goal=intent,
-                target_url=target_url,
-                output_dir=output,
-                max_steps=max_steps,
-            )
+            try:
+                result = await runner.run_browserbase(
+                    persona=persona_data,
+                    goal=intent,
+                    target_url=target_url,
+                    output_dir=output,
+                    max_steps=max_steps,
+                )
+            finally:
+                # Single run per process: don't leave the pooled session open
+                await close_browserbase_pool()
         os.makedirs(output, exist_ok=True)
         out_file = os.path.join(
             output,
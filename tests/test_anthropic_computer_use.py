@@ -0,0 +1,29 @@
+from types import SimpleNamespace
+
+from simulated_web_agent.executor.anthropic_computer_use import _normalize_blocks
+
+
+def test_normalize_blocks_sdk_shapes():
+    content = [
+        SimpleNamespace(type="text", text="looking at the page"),
+        SimpleNamespace(type="tool_use", id="tu_1", name="computer", input={"action": "screenshot"}),
+        SimpleNamespace(type="tool_use", id="tu_2", name="other", input=None),
+    ]
+    blocks, tool_uses = _normalize_blocks(content)
+    assert blocks == [
+        {"type": "text", "text": "looking at the page"},
+        {"type": "tool_use", "id": "tu_1", "name": "computer", "input": {"action": "screenshot"}},
+        {"type": "tool_use", "id": "tu_2", "name": "other", "input": {}},
+    ]
+    assert tool_uses == [blocks[1]]
+
+
+def test_normalize_blocks_fallback_shapes():
+    # No .type at all, and a tool_use missing its fields: both take the generic path
+    content = ["plain string", SimpleNamespace(type="tool_use", name="computer")]
+    blocks, tool_uses = _normalize_blocks(content)
+    assert blocks == [
+        {"type": "text", "text": "plain string"},
+        {"type": "tool_use", "id": None, "name": "computer", "input": {}},
+    ]
+    assert tool_uses == [blocks[1]]
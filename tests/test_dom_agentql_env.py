@@ -0,0 +1,29 @@
+import pytest
+
+from simulated_web_agent.executor.dom_agentql_env import _route_instruction
+
+
+@pytest.mark.parametrize(
+    "instruction, route",
+    [
+        ("press enter or submit search", "submit"),
+        ("type coffee and press enter", "submit"),
+        ("submit", "submit"),
+        ("select size from dropdown", "select"),
+        ("choose option Large", "select"),
+        ('fill search box with "coffee"', "input"),
+        ('fill search box with "press kit"', "input"),
+        ('fill notes with "dropdown"', "input"),
+        ('fill search box with "choose option pack"', "input"),
+        ('fill search box with "press enter"', "input"),
+        ("enter your email", "input"),
+        ("scroll down to explore the page", "nav"),
+        ("go to the cart", "nav"),
+        ("click add to cart", "click"),
+        ("select product", "click"),
+        ("tap the menu", "click"),
+        ("browse product sections", None),
+    ],
+)
+def test_route_instruction(instruction, route):
+    assert _route_instruction(instruction) == route